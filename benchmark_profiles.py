@@ -0,0 +1,102 @@
+from os.path import join as pjoin, basename
+import click
+import os
+import sys
+import json
+import time
+import random
+import logging
+import tempfile
+from osgeo import gdal
+from cog_engine import write_cog
+from cog_profiles import PROFILES
+
+
+def _tile_read_latency(fname, tile_reads, rng):
+    """ Median seconds to open the COG and read one random 512x512 tile, without the block cache """
+    ds = gdal.Open(fname, gdal.GA_ReadOnly)
+    xsize, ysize = ds.RasterXSize, ds.RasterYSize
+    ds = None
+    timings = []
+    for _ in range(tile_reads):
+        x = rng.randrange(0, max(xsize // 512, 1)) * 512
+        y = rng.randrange(0, max(ysize // 512, 1)) * 512
+        start = time.perf_counter()
+        ds = gdal.Open(fname, gdal.GA_ReadOnly)
+        ds.GetRasterBand(1).ReadRaster(x, y, min(512, xsize - x), min(512, ysize - y))
+        ds = None
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] if timings else None
+
+
+def benchmark_profile(fnames, profile, outdir, tile_reads, seed=0):
+    """ Convert fnames under profile into outdir and return the encode time, sizes and tile read latency """
+    rng = random.Random(seed)
+    options = {'engine': 'gdal', 'profile': profile}
+    result = {'profile': profile, 'files': 0, 'encode_seconds': 0.0, 'input_bytes': 0, 'output_bytes': 0,
+              'tile_read_seconds': []}
+    for fname in fnames:
+        out_fname = pjoin(outdir, profile + '_' + basename(fname))
+        start = time.perf_counter()
+        write_cog(fname, out_fname, options)
+        result['encode_seconds'] += time.perf_counter() - start
+        result['files'] += 1
+        result['input_bytes'] += os.path.getsize(fname)
+        result['output_bytes'] += os.path.getsize(out_fname)
+        latency = _tile_read_latency(out_fname, tile_reads, rng)
+        if latency is not None:
+            result['tile_read_seconds'].append(latency)
+        os.remove(out_fname)
+    latencies = sorted(result.pop('tile_read_seconds'))
+    result['tile_read_ms'] = latencies[len(latencies) // 2] * 1000 if latencies else None
+    return result
+
+
+def _print_report(results):
+    print('%-10s %6s %10s %10s %12s %8s %10s' % ('profile', 'files', 'encode s', 'MB/s', 'output MB', 'ratio',
+                                                 'tile ms'))
+    for r in results:
+        mb_in = r['input_bytes'] / 1e6
+        print('%-10s %6i %10.2f %10.2f %12.2f %8.3f %10s' % (
+            r['profile'], r['files'], r['encode_seconds'],
+            mb_in / r['encode_seconds'] if r['encode_seconds'] else 0,
+            r['output_bytes'] / 1e6,
+            r['output_bytes'] / float(r['input_bytes']) if r['input_bytes'] else 0,
+            '%.2f' % r['tile_read_ms'] if r['tile_read_ms'] is not None else '-'))
+
+
+@click.command(help="\b Convert a sample of Geotiffs under each COG creation profile and report the encode time,"
+                    " output size and tile read latency.")
+@click.option('--path', '-p', required=True, help="Read the sample Geotiffs from this folder",
+              type=click.Path(exists=True, readable=True))
+@click.option('--profile', 'profiles', multiple=True, help="Profile to benchmark, default all of them",
+              type=click.Choice(sorted(PROFILES)))
+@click.option('--tile-reads', default=20, show_default=True, help="Random tile reads per output file",
+              type=click.IntRange(min=0))
+@click.option('--json', 'json_fname', default=None, help="Also write the results to this JSON file",
+              type=click.Path(dir_okay=False, writable=True))
+def main(path, profiles, tile_reads, json_fname):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    fnames = sorted(pjoin(root, fname) for root, _, files in os.walk(os.path.abspath(path))
+                    for fname in files if fname.endswith('.tif'))
+    if not fnames:
+        logging.error("No Geotiffs found in %s", path)
+        sys.exit(1)
+    gdal.SetConfigOption('GDAL_CACHEMAX', '1')
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for profile in profiles or sorted(PROFILES):
+            logging.info("Benchmarking profile %s on %i files", profile, len(fnames))
+            try:
+                results.append(benchmark_profile(fnames, profile, tmpdir, tile_reads))
+            except RuntimeError as e:
+                logging.error("Profile %s failed: %s", profile, e)
+    _print_report(results)
+    if json_fname:
+        with open(json_fname, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+""" End to end regression benchmark of the converters on synthetic fixtures
+
+    For every size and data type, the fixtures are generated once into the work folder:
+    geotiff_strips: uncompressed, stripped Geotiffs (read in place with --memmap)
+    geotiff_tiled: tiled, DEFLATE compressed Geotiffs (overviews only with --fast-path)
+    netcdf_unstacked: datacube style netcdfs of one time slice
+    netcdf_stacked: datacube style netcdfs of TIME_SLICES time slices
+    netcdf_stack_bands: the stacked netcdfs converted with --stack-bands
+    The netcdfs have two measurements, a crs grid mapping and the 'dataset' variable of yaml documents
+    that _write_dataset reads, and some nodata at the west edge of every raster.
+    Each case runs geotiff-cog.py or netcdf-cog.py on its fixtures in a fresh output folder, then
+    verify_cog.py on the outputs, and records the throughput in source MB/s, the peak RSS of the
+    converter and its workers, the size of the COGs and the number of COGs that are not valid.
+    Compared with a --baseline of an earlier run, a case fails when its throughput drops, or its
+    peak memory or output size grows, by more than --threshold. Any invalid COG fails the run.
+"""
+from os.path import join as pjoin, dirname, abspath, exists
+import click
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import socket
+import logging
+import tempfile
+import subprocess
+import numpy
+import yaml
+import netCDF4
+from osgeo import gdal, osr
+from cog_engine import ENGINES, default_engine
+
+HERE = dirname(abspath(__file__))
+SIZES = {'small': 1024, 'medium': 4096, 'large': 10240}
+# Data type: (gdal data type name, nodata)
+DTYPES = {'uint8': ('Byte', 255), 'int16': ('Int16', -999), 'float32': ('Float32', -999.0)}
+KINDS = ('geotiff_strips', 'geotiff_tiled', 'netcdf_unstacked', 'netcdf_stacked', 'netcdf_stack_bands')
+MEASUREMENTS = ('blue', 'green')
+TIME_SLICES = 4
+EPSG = 3577
+GEOTRANSFORM = (1500000.0, 25.0, 0.0, -3900000.0, 0.0, -25.0)
+ROWS = 512
+# Metric: True if a higher value is better
+METRICS = {'mb_per_s': True, 'peak_rss_mb': False, 'output_bytes': False}
+
+
+def _wkt():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    return srs.ExportToWkt()
+
+
+def _synthetic_rows(rng, size, dtype, y_start, rows):
+    """ rows rows of a smooth field with noise, the first size/16 columns nodata """
+    y, x = numpy.mgrid[y_start:y_start + rows, 0:size]
+    field = 100 + 50 * numpy.sin(x / 97.0) + 50 * numpy.cos(y / 131.0) + rng.normal(0, 10, (rows, size))
+    if dtype == 'uint8':
+        data = numpy.clip(field, 0, 254).astype(numpy.uint8)
+    elif dtype == 'int16':
+        data = (field * 20).astype(numpy.int16)
+    else:
+        data = (field / 100).astype(numpy.float32)
+    data[:, :size // 16] = DTYPES[dtype][1]
+    return data
+
+
+def write_geotiff(fname, size, dtype, tiled, seed=0):
+    """ A single band Geotiff of size x size pixels, tiled and DEFLATE compressed or uncompressed strips """
+    rng = numpy.random.RandomState(seed)
+    options = ['TILED=YES', 'COMPRESS=DEFLATE'] if tiled else ['COMPRESS=NONE']
+    ds = gdal.GetDriverByName('GTiff').Create(fname, size, size, 1, gdal.GetDataTypeByName(DTYPES[dtype][0]),
+                                              options)
+    if ds is None:
+        raise RuntimeError("Unable to create {}: {}".format(fname, gdal.GetLastErrorMsg()))
+    ds.SetGeoTransform(GEOTRANSFORM)
+    ds.SetProjection(_wkt())
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(DTYPES[dtype][1])
+    for y_start in range(0, size, ROWS):
+        band.WriteArray(_synthetic_rows(rng, size, dtype, y_start, min(ROWS, size - y_start)), 0, y_start)
+    ds = None
+
+
+def _dataset_doc(fname, count, center_dt):
+    """ The datacube dataset yaml of one time slice, its bands pointing at the netcdf variables """
+    return yaml.safe_dump({'id': str(uuid.uuid5(uuid.NAMESPACE_URL, '{}#{}'.format(fname, count))),
+                           'product_type': 'benchmark',
+                           'creation_dt': '2018-01-01T00:00:00',
+                           'extent': {'center_dt': center_dt},
+                           'format': {'name': 'NetCDF'},
+                           'grid_spatial': {'projection': {'spatial_reference': 'EPSG:{}'.format(EPSG)}},
+                           'image': {'bands': {name: {'path': '', 'layer': name} for name in MEASUREMENTS}},
+                           'lineage': {'source_datasets': {}}},
+                          default_flow_style=False)
+
+
+def write_netcdf(fname, size, dtype, time_slices, seed=0):
+    """ A datacube style netcdf: time, y, x coordinates, a crs grid mapping, MEASUREMENTS of
+        time_slices x size x size pixels in 512x512 chunks, and the 'dataset' yaml of every slice
+        The 'dataset' variable is the last one, as netcdf-cog.py leaves out the last subdataset
+    """
+    rng = numpy.random.RandomState(seed)
+    times = [1514764800 + 16 * 86400 * count for count in range(time_slices)]
+    with netCDF4.Dataset(fname, 'w') as nc:
+        nc.createDimension('time', time_slices)
+        nc.createDimension('y', size)
+        nc.createDimension('x', size)
+        variable = nc.createVariable('time', 'f8', ('time',))
+        variable.units = 'seconds since 1970-01-01 00:00:00'
+        variable.calendar = 'standard'
+        variable[:] = times
+        variable = nc.createVariable('y', 'f8', ('y',))
+        variable.units = 'metre'
+        variable.standard_name = 'projection_y_coordinate'
+        variable[:] = GEOTRANSFORM[3] + GEOTRANSFORM[5] * (numpy.arange(size) + 0.5)
+        variable = nc.createVariable('x', 'f8', ('x',))
+        variable.units = 'metre'
+        variable.standard_name = 'projection_x_coordinate'
+        variable[:] = GEOTRANSFORM[0] + GEOTRANSFORM[1] * (numpy.arange(size) + 0.5)
+        crs = nc.createVariable('crs', 'i4')
+        crs.grid_mapping_name = 'albers_conical_equal_area'
+        crs.spatial_ref = _wkt()
+        crs.crs_wkt = crs.spatial_ref
+        chunk = min(size, 512)
+        for name in MEASUREMENTS:
+            variable = nc.createVariable(name, dtype, ('time', 'y', 'x'), zlib=True, chunksizes=(1, chunk, chunk),
+                                         fill_value=DTYPES[dtype][1])
+            variable.grid_mapping = 'crs'
+            variable.units = '1'
+            for count in range(time_slices):
+                for y_start in range(0, size, ROWS):
+                    rows = min(ROWS, size - y_start)
+                    variable[count, y_start:y_start + rows, :] = _synthetic_rows(rng, size, dtype, y_start, rows)
+        docs = [_dataset_doc(fname, count, time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))).encode('utf-8')
+                for count, seconds in enumerate(times)]
+        nchar = max(len(doc) for doc in docs)
+        nc.createDimension('dataset_nchar', nchar)
+        variable = nc.createVariable('dataset', 'S1', ('time', 'dataset_nchar'))
+        # A (time, nchar) array of single characters, built directly: stringtochar of an 'S' array depends on
+        # its encoding argument, which changed across netCDF4 versions
+        chars = numpy.array(docs, 'S{}'.format(nchar)).view('S1')
+        variable[:] = chars.reshape(time_slices, nchar)
+
+
+def _cases(sizes, dtypes, kinds):
+    for size in sizes:
+        for dtype in dtypes:
+            for kind in kinds:
+                # --stack-bands converts the same netcdfs as netcdf_stacked
+                fixtures = 'netcdf_stacked' if kind == 'netcdf_stack_bands' else kind
+                yield {'name': '{}_{}_{}'.format(kind, dtype, size), 'kind': kind, 'size': SIZES[size],
+                       'dtype': dtype, 'fixtures': '{}_{}_{}'.format(fixtures, dtype, size)}
+
+
+def make_fixtures(case, folder, files):
+    """ Write the files fixtures of case into folder, unless a previous run already did """
+    os.makedirs(folder, exist_ok=True)
+    for index in range(files):
+        kind = case['kind']
+        if kind.startswith('geotiff'):
+            fname = pjoin(folder, 'fixture_{}.tif'.format(index))
+            if not exists(fname):
+                write_geotiff(fname + '.part', case['size'], case['dtype'], kind == 'geotiff_tiled', seed=index)
+                os.replace(fname + '.part', fname)
+        else:
+            fname = pjoin(folder, 'fixture_{}.nc'.format(index))
+            if not exists(fname):
+                write_netcdf(fname + '.part', case['size'], case['dtype'],
+                             1 if kind == 'netcdf_unstacked' else TIME_SLICES, seed=index)
+                os.replace(fname + '.part', fname)
+
+
+def _run(command, log_fname):
+    """ Run command, return its seconds, the peak RSS in MB of it and the children it waited for, exit code """
+    start = time.perf_counter()
+    with open(log_fname, 'a') as log:
+        log.write('$ {}\n'.format(' '.join(command)))
+        log.flush()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=HERE)
+        _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return time.perf_counter() - start, usage.ru_maxrss / 1024.0, process.returncode
+
+
+def _folder_bytes(folder, suffix):
+    return sum(os.path.getsize(pjoin(root, fname)) for root, _, files in os.walk(folder)
+               for fname in files if fname.endswith(suffix))
+
+
+def run_case(case, workdir, workers, engine):
+    """ Convert the fixtures of case and verify the COGs, return the measurements """
+    inputs = pjoin(workdir, 'inputs', case['fixtures'])
+    outputs = pjoin(workdir, 'outputs', case['name'])
+    if exists(outputs):
+        shutil.rmtree(outputs)
+    os.makedirs(outputs)
+    log_fname = pjoin(workdir, case['name'] + '.log')
+    script = 'geotiff-cog.py' if case['kind'].startswith('geotiff') else 'netcdf-cog.py'
+    command = [sys.executable, script, '-p', inputs, '-o', outputs, '-w', str(workers), '-e', engine,
+               '--no-manifest', '--no-index']
+    if case['kind'] == 'netcdf_stack_bands':
+        command.append('--stack-bands')
+    seconds, peak_rss_mb, exit_code = _run(command, log_fname)
+
+    results_fname = pjoin(workdir, case['name'] + '.verify.jsonl')
+    _run([sys.executable, 'verify_cog.py', '-p', outputs, '-b', 'ifd', '-f', 'jsonl', '-o', results_fname],
+         log_fname)
+    cogs = invalid = 0
+    if exists(results_fname):
+        with open(results_fname) as fp:
+            for line in fp:
+                cogs += 1
+                invalid += not json.loads(line)['valid']
+    input_bytes = _folder_bytes(inputs, '.tif' if script == 'geotiff-cog.py' else '.nc')
+    return {'case': case['name'],
+            'exit_code': exit_code,
+            'seconds': seconds,
+            'input_bytes': input_bytes,
+            'mb_per_s': input_bytes / 1e6 / seconds if seconds else None,
+            'peak_rss_mb': peak_rss_mb,
+            'output_bytes': _folder_bytes(outputs, '.tif'),
+            'cogs': cogs,
+            'invalid': invalid}
+
+
+def compare(results, baseline, threshold):
+    """ The regressions of results against the baseline cases, as messages """
+    regressions = []
+    for result in results:
+        base = baseline.get(result['case'])
+        if base is None:
+            continue
+        for metric, higher_is_better in sorted(METRICS.items()):
+            value, reference = result[metric], base.get(metric)
+            if value is None or not reference:
+                continue
+            change = value / float(reference) - 1
+            if (change < -threshold) if higher_is_better else (change > threshold):
+                regressions.append("{}: {} {:.4g} against {:.4g} in the baseline ({:+.0%})".format(
+                    result['case'], metric, value, reference, change))
+    return regressions
+
+
+def _print_report(results, baseline):
+    print('%-36s %4s %6s %10s %8s %10s %10s %6s %8s' % ('case', 'exit', 'COGs', 'seconds', 'MB/s', 'peak MB',
+                                                       'output MB', 'bad', 'base MB/s'))
+    for r in results:
+        base = baseline.get(r['case'], {})
+        print('%-36s %4i %6i %10.2f %8.1f %10.0f %10.2f %6i %8s' % (
+            r['case'], r['exit_code'], r['cogs'], r['seconds'], r['mb_per_s'] or 0, r['peak_rss_mb'],
+            r['output_bytes'] / 1e6, r['invalid'], '%.1f' % base['mb_per_s'] if base.get('mb_per_s') else '-'))
+
+
+@click.command(help="\b Generate synthetic Geotiff and netcdf fixtures, convert them with geotiff-cog.py and"
+                    " netcdf-cog.py, verify the COGs and compare the throughput, peak memory and output size"
+                    " with a baseline.")
+@click.option('--size', 'sizes', multiple=True, default=['small'], show_default=True,
+              type=click.Choice(sorted(SIZES)), help="Raster sizes to benchmark, can be repeated")
+@click.option('--dtype', 'dtypes', multiple=True, default=sorted(DTYPES), show_default=True,
+              type=click.Choice(sorted(DTYPES)), help="Data types to benchmark, can be repeated")
+@click.option('--kind', 'kinds', multiple=True, default=KINDS, show_default=True, type=click.Choice(KINDS),
+              help="Fixture kinds to benchmark, can be repeated")
+@click.option('--files', default=2, show_default=True, help="Fixtures of each case", type=click.IntRange(min=1))
+@click.option('--workers', '-w', default=1, show_default=True, help="Workers of the converters",
+              type=click.IntRange(min=1))
+@click.option('--engine', '-e', default=default_engine(), show_default=True, type=click.Choice(ENGINES),
+              help="Engine of the converters")
+@click.option('--repeat', default=1, show_default=True, type=click.IntRange(min=1),
+              help="Runs of each case, the fastest is kept")
+@click.option('--workdir', default=None, type=click.Path(file_okay=False, writable=True),
+              help="Keep the fixtures, outputs and logs in this folder, the fixtures are reused by later runs")
+@click.option('--baseline', default=None, type=click.Path(exists=True, dir_okay=False),
+              help="Compare with the results of this earlier run")
+@click.option('--save-baseline', default=None, type=click.Path(dir_okay=False, writable=True),
+              help="Write the results as a baseline to this file")
+@click.option('--threshold', default=0.2, show_default=True, type=click.FloatRange(min=0),
+              help="Relative change of a metric against the baseline that fails the run")
+@click.option('--json', 'json_fname', default=None, type=click.Path(dir_okay=False, writable=True),
+              help="Also write the results to this JSON file")
+def main(sizes, dtypes, kinds, files, workers, engine, repeat, workdir, baseline, save_baseline, threshold,
+         json_fname):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    temp_dir = None
+    if workdir is None:
+        temp_dir = tempfile.TemporaryDirectory()
+        workdir = temp_dir.name
+    workdir = os.path.abspath(workdir)
+    baseline_cases = {}
+    if baseline:
+        with open(baseline) as fp:
+            baseline_cases = json.load(fp)['cases']
+    results = []
+    try:
+        for case in _cases(sizes, dtypes, kinds):
+            logging.info("Generating the fixtures of %s", case['name'])
+            make_fixtures(case, pjoin(workdir, 'inputs', case['fixtures']), files)
+            runs = []
+            for _ in range(repeat):
+                logging.info("Running %s", case['name'])
+                runs.append(run_case(case, workdir, workers, engine))
+            results.append(max(runs, key=lambda run: run['mb_per_s'] or 0))
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+    _print_report(results, baseline_cases)
+
+    cases = {result['case']: {metric: result[metric] for metric in METRICS} for result in results}
+    if save_baseline:
+        with open(save_baseline, 'w') as fp:
+            json.dump({'host': socket.gethostname(), 'gdal': gdal.__version__, 'engine': engine,
+                       'workers': workers, 'cases': cases}, fp, indent=2, sort_keys=True)
+    if json_fname:
+        with open(json_fname, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    failures = ["{}: the converter exited with {}".format(r['case'], r['exit_code'])
+                for r in results if r['exit_code']]
+    failures += ["{}: {} of {} COGs are not valid".format(r['case'], r['invalid'], r['cogs'])
+                 for r in results if r['invalid'] or not r['cogs']]
+    failures += compare(results, baseline_cases, threshold)
+    for failure in failures:
+        logging.error(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+""" Catalogues of the COGs converted from one stacked netcdf, so readers do not open every COG header
+
+    VRT: one <name>_<band>.vrt per measurement, with a band per time slice pointing at its COG
+    STAC: one <name>.stac.json item collection, an item per time slice with its datetime, lon/lat bbox
+          and geometry, the projection (proj:epsg, proj:transform, proj:shape) and an asset per
+          measurement with its layer, overview sizes, tile size and the number of bytes before its
+          first tile, so one range request reads its whole header
+"""
+from os.path import basename, dirname, relpath
+import json
+from osgeo import gdal, osr
+from tiff_ifd import open_tiff
+from cog_publish import temp_name, publish, publish_bytes
+
+CATALOGUES = ('vrt', 'stac')
+STAC_VERSION = '1.0.0'
+PROJECTION_EXTENSION = 'https://stac-extensions.github.io/projection/v1.0.0/schema.json'
+COG_MEDIA_TYPE = 'image/tiff; application=geotiff; profile=cloud-optimized'
+
+
+def write_vrt(vrt_fname, fnames, band=1, descriptions=None):
+    """ Write a VRT with band band of each of fnames as its bands, in order, with their descriptions """
+    # Written next to vrt_fname, so the paths of the COGs are relative to the same folder
+    temp_fname = temp_name(vrt_fname)
+    vrt_ds = gdal.BuildVRT(temp_fname, fnames, separate=True, bandList=[band])
+    if vrt_ds is None:
+        raise RuntimeError("Unable to write {}: {}".format(vrt_fname, gdal.GetLastErrorMsg()))
+    for index, description in enumerate(descriptions or []):
+        vrt_ds.GetRasterBand(index + 1).SetDescription(description)
+    # Closing the dataset writes it
+    vrt_ds = None
+    publish(temp_fname, vrt_fname)
+    return vrt_fname
+
+
+def cog_layout(fname):
+    """ The sizes of the overviews, the tile size and the bytes before the first tile of the COG fname """
+    tiff = open_tiff(fname)
+    try:
+        first_block = min(offset for ifd in tiff.ifds for offset in ifd.block_offsets(0, 1) if offset)
+        return {'cog:overviews': [[ifd.width, ifd.height] for ifd in tiff.overviews],
+                'cog:tile_size': list(tiff.main.block_size),
+                'cog:header_bytes': first_block}
+    finally:
+        tiff.reader.close()
+
+
+def _geometry(fname):
+    """ The projection properties and the lon/lat bbox and footprint of the raster fname """
+    ds = gdal.Open(fname, gdal.GA_ReadOnly)
+    if ds is None:
+        raise RuntimeError("Unable to open {}: {}".format(fname, gdal.GetLastErrorMsg()))
+    gt = ds.GetGeoTransform()
+    xsize, ysize = ds.RasterXSize, ds.RasterYSize
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    corners = [(gt[0] + px * gt[1] + py * gt[2], gt[3] + px * gt[4] + py * gt[5])
+               for px, py in ((0, 0), (xsize, 0), (xsize, ysize), (0, ysize))]
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        # GDAL 3 would otherwise use the lat/lon axis order of EPSG:4326
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(srs, wgs84)
+    lonlat = [list(transform.TransformPoint(x, y)[:2]) for x, y in corners]
+    srs.AutoIdentifyEPSG()
+    epsg = srs.GetAuthorityCode(None)
+    ds = None
+    return {'bbox': [min(p[0] for p in lonlat), min(p[1] for p in lonlat),
+                     max(p[0] for p in lonlat), max(p[1] for p in lonlat)],
+            'geometry': {'type': 'Polygon', 'coordinates': [lonlat + [lonlat[0]]]},
+            'projection': {'proj:epsg': int(epsg) if epsg else None,
+                           'proj:transform': [gt[1], gt[2], gt[0], gt[4], gt[5], gt[3]],
+                           'proj:shape': [ysize, xsize]}}
+
+
+def write_stac(json_fname, slices):
+    """ Write a STAC item collection of the time slices
+        slices: [{'id': item id, 'datetime': ISO 8601 string, 'assets': {band: (COG file name, layer)}}]
+    """
+    folder = dirname(json_fname)
+    first_fname = next(iter(slices[0]['assets'].values()))[0]
+    geometry = _geometry(first_fname)
+    features = []
+    for time_slice in slices:
+        assets = {}
+        for band, (fname, layer) in sorted(time_slice['assets'].items()):
+            asset = {'href': relpath(fname, folder), 'type': COG_MEDIA_TYPE, 'roles': ['data'], 'cog:layer': layer}
+            asset.update(cog_layout(fname))
+            assets[band] = asset
+        properties = {'datetime': time_slice['datetime']}
+        properties.update(geometry['projection'])
+        features.append({'type': 'Feature',
+                         'stac_version': STAC_VERSION,
+                         'stac_extensions': [PROJECTION_EXTENSION],
+                         'id': time_slice['id'],
+                         'bbox': geometry['bbox'],
+                         'geometry': geometry['geometry'],
+                         'properties': properties,
+                         'assets': assets,
+                         'links': []})
+    text = json.dumps({'type': 'FeatureCollection', 'features': features}, indent=1)
+    publish_bytes(json_fname, text.encode('utf-8'))
+    return json_fname
+
+
+def write_catalogues(out_f_name, slices, catalogues):
+    """ Write the catalogues (names of CATALOGUES) of the time slices converted to out_f_name* COGs,
+        return the file names written
+    """
+    fnames = []
+    if 'vrt' in catalogues:
+        bands = sorted(set(band for time_slice in slices for band in time_slice['assets']))
+        for band in bands:
+            sources = [time_slice['assets'][band] for time_slice in slices if band in time_slice['assets']]
+            layers = set(layer for _, layer in sources)
+            if len(layers) != 1:
+                raise RuntimeError("Band {} is not at the same layer of every COG of {}".format(
+                    band, basename(out_f_name)))
+            descriptions = [time_slice['datetime'] or time_slice['id']
+                            for time_slice in slices if band in time_slice['assets']]
+            fnames.append(write_vrt(out_f_name + '_' + band + '.vrt', [fname for fname, _ in sources],
+                                    layers.pop(), descriptions))
+    if 'stac' in catalogues:
+        fnames.append(write_stac(out_f_name + '.stac.json', slices))
+    return fnames
@@ -0,0 +1,369 @@
+from os.path import join as pjoin, basename, dirname
+import os
+import tempfile
+import subprocess
+import uuid
+import json
+import logging
+import resource
+from subprocess import check_call
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+from cog_profiles import profile_options, DEFAULT_PROFILE
+from cog_overviews import overview_levels, build_overviews
+from cog_metrics import stage
+from cog_publish import temp_name, publish
+from cog_memmap import mapped_dataset
+
+ENGINES = ('gdal', 'subprocess')
+
+# Intermediate GTiff of the streaming mode
+STREAM_BLOCKSIZE = 512
+STREAM_CREATION_OPTIONS = ['TILED=YES',
+                           'BLOCKXSIZE=512',
+                           'BLOCKYSIZE=512',
+                           'COMPRESS=DEFLATE',
+                           'ZLEVEL=1',
+                           'BIGTIFF=IF_SAFER']
+
+# Largest raster copied into /vsimem/, a larger one is copied to a file on disk, in MB
+VSIMEM_MAX_MB = 1024
+
+GDAL_ENV = {'GDAL_DISABLE_READDIR_ON_OPEN': 'YES',
+            'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif',
+            'GDAL_TIFF_OVR_BLOCKSIZE': '512'}
+
+
+def num_threads(threads):
+    """ The gdal NUM_THREADS value of the --threads option, 0 is all the cpus """
+    return 'ALL_CPUS' if threads == 0 else str(threads)
+
+
+def default_engine():
+    """ The in-process engine when the GDAL python bindings are available, else the gdal command line tools """
+    return 'gdal' if gdal is not None else 'subprocess'
+
+
+def run_command(command, work_dir):
+    """
+    A simple utility to execute a subprocess command.
+    """
+    env = dict(os.environ, **GDAL_ENV)
+    try:
+        check_call(command, stderr=subprocess.STDOUT, cwd=work_dir, env=env)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError("command '{}' return with error (code {}): {}".format(e.cmd, e.returncode, e.output))
+
+
+def cog_creation_options(profile, dtype):
+    """ Creation options of the final COG
+        Blocksize is 512
+        TILED <boolean>: Switch to tiled format
+        COPY_SRC_OVERVIEWS <boolean>: Force copy of overviews of source dataset
+        BLOCKXSIZE <int>: Tile Width
+        BLOCKYSIZE <int>: Tile/Strip Height
+        PROFILE <string-select>: possible values: GDALGeoTIFF,GeoTIFF,BASELINE,
+        plus the compression options of profile, see cog_profiles
+    """
+    return ['TILED=YES',
+            'COPY_SRC_OVERVIEWS=YES',
+            'BLOCKXSIZE=512',
+            'BLOCKYSIZE=512',
+            'PROFILE=GeoTIFF'] + profile_options(profile, dtype)
+
+
+def source_info(src, band=None):
+    """ The gdal data type name of band (default the first) of src, the raster size and the number of bands """
+    band_count = 1 if band else None
+    band = band or 1
+    if gdal is not None:
+        ds = gdal.Open(src, gdal.GA_ReadOnly) if isinstance(src, str) else src
+        if ds is None:
+            raise _gdal_error("Unable to open {}".format(src))
+        return {'dtype': gdal.GetDataTypeName(ds.GetRasterBand(band).DataType),
+                'xsize': ds.RasterXSize,
+                'ysize': ds.RasterYSize,
+                'bands': band_count or ds.RasterCount}
+    info = json.loads(subprocess.check_output(['gdalinfo', '-json', src], env=dict(os.environ, **GDAL_ENV)))
+    return {'dtype': info['bands'][band - 1]['type'],
+            'xsize': info['size'][0],
+            'ysize': info['size'][1],
+            'bands': band_count or len(info['bands'])}
+
+
+def geotiff_layout(fname):
+    """ The layout of the GeoTIFF fname: its validate() errors as a COG, its compression and whether it is tiled
+        None if it can not be inspected with the GDAL bindings
+    """
+    from validate_cloud_optimized_geotiff import validate, ValidateCloudOptimizedGeoTIFFException
+    if gdal is None:
+        return None
+    ds = gdal.Open(fname, gdal.GA_ReadOnly)
+    if ds is None or ds.GetDriver().ShortName != 'GTiff':
+        return None
+    try:
+        errors, _ = validate(ds)
+    except ValidateCloudOptimizedGeoTIFFException as e:
+        errors = [str(e)]
+    block_x, block_y = ds.GetRasterBand(1).GetBlockSize()
+    return {'errors': errors,
+            'compression': ds.GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION'),
+            'tiled': block_x < ds.RasterXSize and block_y > 1}
+
+
+def write_cog(src, out_fname, options, band=None, copy_source=True):
+    """ Convert src (a file name or gdal subdataset name) to a COG at out_fname
+        src can also be an open gdal Dataset when converting in-process
+        band <int>: Only convert this band of src
+        options['engine']: 'gdal' to convert in-process through the GDAL bindings,
+                           'subprocess' to run gdal_translate/gdaladdo
+        options['profile']: Name of the compression profile, see cog_profiles
+        options['resampling']: average, mode or nearest, see cog_overviews
+        options['overviews']: 'numpy' to build the overviews with cog_overviews, 'gdal' with gdal,
+                              only with the in-process engine
+        options['interleave']: 'pixel' or 'band', the layout of the bands of a multi-band COG
+        options['threads']: Number of threads compressing the tiles and building the overviews with gdal,
+                            0 for all the cpus. Needs GDAL >= 2.1, and >= 3.2 for the overviews
+        options['memory_limit']: Stream the source through a tiled intermediate on disk in windows of
+                                 512 rows, keeping the memory used under this many MB, see _stream_copy.
+                                 Only with the in-process engine
+        options['memmap']: Read an uncompressed, stripped GTiff src in place instead of copying it, see
+                           cog_memmap. Only with the in-process engine, without a memory_limit and for a
+                           raster up to VSIMEM_MAX_MB
+        copy_source <bool>: False to build the overviews on a VRT of src instead of a full copy of it,
+                            for a src that is already tiled. The overviews are then built by gdal
+        The COG is written next to out_fname and only replaces it if their content differs, see cog_publish.
+        Return True if out_fname changed
+    """
+    engine = options.get('engine') or default_engine()
+    info = source_info(src, band)
+    creation_options = cog_creation_options(options.get('profile', DEFAULT_PROFILE), info['dtype'])
+    if options.get('interleave'):
+        creation_options.append('INTERLEAVE={}'.format(options['interleave'].upper()))
+    threads = options.get('threads', 1)
+    if threads != 1:
+        creation_options.append('NUM_THREADS={}'.format(num_threads(threads)))
+    levels = overview_levels(info['xsize'], info['ysize'])
+    resampling = options.get('resampling', 'average')
+    temp_fname = temp_name(out_fname)
+    try:
+        if engine == 'gdal':
+            _write_cog_gdal(src, temp_fname, band, creation_options, levels, resampling,
+                            options.get('overviews', 'numpy'), options.get('memory_limit'), copy_source, threads,
+                            options.get('memmap', False))
+        else:
+            _write_cog_subprocess(src, temp_fname, band, creation_options, levels, resampling, copy_source, threads)
+        with stage('publish'):
+            return publish(temp_fname, out_fname)
+    finally:
+        if os.path.exists(temp_fname):
+            os.remove(temp_fname)
+
+
+def _gdal_error(message):
+    return RuntimeError("{}: {}".format(message, gdal.GetLastErrorMsg()))
+
+
+def _write_cog_gdal(src, out_fname, band, creation_options, levels, resampling, overviews, memory_limit=None,
+                    copy_source=True, threads=1, memmap=False):
+    """ Same steps as the gdal command line pipeline, with the intermediate GTiff held in /vsimem/
+        instead of a temporary file on disk
+        A raster larger than VSIMEM_MAX_MB is copied to a tiled, compressed GTiff next to out_fname instead,
+        so the workers do not each hold a full copy of a large raster in memory
+        With a memory_limit the intermediate is streamed to a tiled, compressed GTiff next to out_fname
+        Without copy_source the intermediate is a VRT of src, its overviews a .ovr GTiff in /vsimem/, or
+        next to out_fname with a memory_limit or for a raster larger than VSIMEM_MAX_MB
+        With memmap, a src that cog_memmap can map is not copied, the intermediate is a MEM dataset over
+        it and only its overviews are held in memory. Not with a memory_limit or for a raster larger than
+        VSIMEM_MAX_MB, whose overviews would not fit in memory either
+    """
+    on_disk = memory_limit or _raster_mb(src, band) > VSIMEM_MAX_MB
+    temp_fname = pjoin(dirname(out_fname) if on_disk else '/vsimem',
+                       '.{}_{}'.format(uuid.uuid4().hex, basename(out_fname)))
+    if not copy_source:
+        overviews = 'gdal'
+        temp_fname = temp_fname + '.vrt'
+    for key, value in GDAL_ENV.items():
+        gdal.SetConfigOption(key, value)
+    if threads != 1:
+        gdal.SetConfigOption('GDAL_NUM_THREADS', num_threads(threads))
+    cache_max = gdal.GetCacheMax()
+    if memory_limit:
+        # Half of the memory for the gdal block cache, a quarter for the window buffers. GDAL_CACHEMAX is
+        # only read when the cache is first used, the cache of a worker is resized with SetCacheMax
+        gdal.SetCacheMax(max(memory_limit // 2, 16) * 1024 * 1024)
+    temp_ds = None
+    mapping = None
+    try:
+        if memmap and copy_source and not on_disk and isinstance(src, str):
+            with stage('map'):
+                temp_ds, mapping = _mapped_copy(src, band)
+        if temp_ds is not None:
+            logging.info("%s: uncompressed strips, read in place", basename(src))
+        else:
+            with stage('copy'):
+                if not copy_source:
+                    temp_ds = gdal.Translate(temp_fname, src, format='VRT', bandList=[band] if band else None)
+                elif memory_limit:
+                    temp_ds = _stream_copy(src, temp_fname, band, memory_limit, threads)
+                elif on_disk:
+                    logging.info("%s: larger than %d MB, copied to disk", basename(out_fname), VSIMEM_MAX_MB)
+                    temp_ds = gdal.Translate(temp_fname, src, format='GTiff', bandList=[band] if band else None,
+                                             creationOptions=STREAM_CREATION_OPTIONS)
+                else:
+                    temp_ds = gdal.Translate(temp_fname, src, format='GTiff', bandList=[band] if band else None)
+        if temp_ds is None:
+            raise _gdal_error("Unable to copy the source of {} to {}".format(out_fname, temp_fname))
+
+        with stage('overviews'):
+            if levels and overviews == 'numpy':
+                build_overviews(temp_ds, levels, resampling,
+                                threads=(os.cpu_count() or 1) if threads == 0 else threads)
+            elif levels and temp_ds.BuildOverviews(resampling.upper(), levels) != 0:
+                raise _gdal_error("Unable to build overviews for {}".format(out_fname))
+
+        with stage('cog'):
+            out_ds = gdal.Translate(out_fname, temp_ds, format='GTiff',
+                                    creationOptions=creation_options)
+            if out_ds is None:
+                raise _gdal_error("Unable to write COG {}".format(out_fname))
+            # Closing the dataset flushes it to disk
+            out_ds = None
+    finally:
+        # The MEM dataset reads the mapping until it is closed
+        temp_ds = None
+        mapping = None
+        gdal.Unlink(temp_fname)
+        if not copy_source:
+            gdal.Unlink(temp_fname + '.ovr')
+        for key in GDAL_ENV:
+            gdal.SetConfigOption(key, None)
+        gdal.SetConfigOption('GDAL_NUM_THREADS', None)
+        gdal.SetCacheMax(cache_max)
+        if memory_limit:
+            logging.info("Wrote %s, peak RSS %.0f MB", basename(out_fname), peak_rss_mb())
+
+
+def _raster_mb(src, band=None):
+    """ Size of the pixels of src (only band if given) uncompressed, in MB """
+    info = source_info(src, band)
+    pixel_bytes = gdal.GetDataTypeSize(gdal.GetDataTypeByName(info['dtype'])) // 8
+    return info['xsize'] * info['ysize'] * info['bands'] * pixel_bytes / 1024.0 / 1024.0
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def copy_metadata(src_ds, dst_ds, bands):
+    """ Copy the georeferencing and metadata of src_ds, and of its bands, to dst_ds, as gdal_translate does
+        bands: The band numbers of src_ds copied to the bands 1, 2 ... of dst_ds
+    """
+    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    dst_ds.SetProjection(src_ds.GetProjection())
+    dst_ds.SetMetadata(src_ds.GetMetadata())
+    for index, src_band_number in enumerate(bands):
+        src_band = src_ds.GetRasterBand(src_band_number)
+        dst_band = dst_ds.GetRasterBand(index + 1)
+        if src_band.GetNoDataValue() is not None:
+            dst_band.SetNoDataValue(src_band.GetNoDataValue())
+        if src_band.GetRasterColorTable() is not None:
+            dst_band.SetRasterColorTable(src_band.GetRasterColorTable())
+        if src_band.GetScale() is not None:
+            dst_band.SetScale(src_band.GetScale())
+        if src_band.GetOffset() is not None:
+            dst_band.SetOffset(src_band.GetOffset())
+        if src_band.GetUnitType():
+            dst_band.SetUnitType(src_band.GetUnitType())
+        dst_band.SetDescription(src_band.GetDescription())
+        dst_band.SetMetadata(src_band.GetMetadata())
+
+
+def _mapped_copy(src, band):
+    """ A MEM dataset reading the GTiff src in place, with its georeferencing, and the mapping it reads
+        (None, None) if src can not be mapped, see cog_memmap
+    """
+    src_ds = gdal.Open(src, gdal.GA_ReadOnly)
+    if src_ds is None or src_ds.GetDriver().ShortName != 'GTiff':
+        return None, None
+    mapped = mapped_dataset(src, band)
+    if mapped is None:
+        return None, None
+    ds, mapping = mapped
+    copy_metadata(src_ds, ds, [band] if band else list(range(1, src_ds.RasterCount + 1)))
+    return ds, mapping
+
+
+def _stream_copy(src, temp_fname, band, memory_limit, threads=1):
+    """ Copy src into a tiled and lightly compressed GTiff, reading windows aligned to the 512x512 tiles:
+        one row of tiles at a time, split into column windows so a window stays under a quarter of
+        memory_limit MB. Memory does not grow with the raster size and the intermediate takes a
+        fraction of the disk space of an untiled copy.
+    """
+    src_ds = gdal.Open(src, gdal.GA_ReadOnly) if isinstance(src, str) else src
+    if src_ds is None:
+        return None
+    bands = [band] if band else list(range(1, src_ds.RasterCount + 1))
+    xsize, ysize = src_ds.RasterXSize, src_ds.RasterYSize
+    datatype = src_ds.GetRasterBand(bands[0]).DataType
+    creation_options = list(STREAM_CREATION_OPTIONS)
+    if threads != 1:
+        creation_options.append('NUM_THREADS={}'.format(num_threads(threads)))
+    temp_ds = gdal.GetDriverByName('GTiff').Create(temp_fname, xsize, ysize, len(bands), datatype,
+                                                   creation_options)
+    if temp_ds is None:
+        return None
+    copy_metadata(src_ds, temp_ds, bands)
+
+    pixel_bytes = gdal.GetDataTypeSize(datatype) // 8 * len(bands)
+    window_width = (memory_limit * 1024 * 1024 // 4 // (STREAM_BLOCKSIZE * pixel_bytes))
+    window_width = max(STREAM_BLOCKSIZE, window_width // STREAM_BLOCKSIZE * STREAM_BLOCKSIZE)
+    for y in range(0, ysize, STREAM_BLOCKSIZE):
+        height = min(STREAM_BLOCKSIZE, ysize - y)
+        for x in range(0, xsize, window_width):
+            width = min(window_width, xsize - x)
+            data = src_ds.ReadRaster(x, y, width, height, band_list=bands)
+            temp_ds.WriteRaster(x, y, width, height, data, band_list=list(range(1, len(bands) + 1)))
+    return temp_ds
+
+
+def _write_cog_subprocess(src, out_fname, band, creation_options, levels, resampling, copy_source=True,
+                          threads=1):
+    """ Convert with the gdal command line tools, going through a temporary GTiff on disk
+        Without copy_source through a temporary VRT of src, gdaladdo writes its overviews to a .ovr GTiff
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        temp_fname = pjoin(tmpdir, basename(out_fname))
+        if not copy_source:
+            temp_fname += '.vrt'
+
+        # copy to a tempfolder
+        to_cogtif = ['gdal_translate', '-of', 'GTIFF' if copy_source else 'VRT']
+        if band:
+            to_cogtif += ['-b', str(band)]
+        to_cogtif += [src, temp_fname]
+        with stage('copy'):
+            run_command(to_cogtif, tmpdir)
+
+        # Add Overviews
+        # gdaladdo - Builds or rebuilds overview images.
+        if levels:
+            add_ovr = ['gdaladdo', '-r', resampling]
+            if threads != 1:
+                add_ovr += ['--config', 'GDAL_NUM_THREADS', num_threads(threads)]
+            add_ovr += [temp_fname] + [str(level) for level in levels]
+            with stage('overviews'):
+                run_command(add_ovr, tmpdir)
+
+        # Convert to COG
+        cogtif = ['gdal_translate']
+        for option in creation_options:
+            cogtif += ['-co', option]
+        cogtif += [temp_fname, out_fname]
+        with stage('cog'):
+            run_command(cogtif, tmpdir)
@@ -0,0 +1,98 @@
+from os.path import join as pjoin
+import os
+import json
+import logging
+import sqlite3
+import time
+from cog_metrics import stage
+
+MANIFEST_NAME = 'cog_manifest.sqlite'
+
+# Options that change how a file is converted but not what is written
+RUNTIME_OPTIONS = ('engine', 'memory_limit', 'threads', 'memmap')
+
+
+def options_key(options):
+    """ The conversion options as a stable string, a change of options means the source is converted again """
+    return json.dumps({key: value for key, value in options.items() if key not in RUNTIME_OPTIONS},
+                      sort_keys=True)
+
+
+def check_outputs(outputs):
+    """ Validate the written COGs with validate_cloud_optimized_geotiff
+        Return a dictionary of output file name to the list of validation errors
+    """
+    from validate_cloud_optimized_geotiff import validate, ValidateCloudOptimizedGeoTIFFException
+    results = {}
+    for out_fname in outputs:
+        if not out_fname.endswith('.tif'):
+            results[out_fname] = []
+            continue
+        try:
+            with stage('validate'):
+                errors, _ = validate(out_fname)
+        except ValidateCloudOptimizedGeoTIFFException as e:
+            errors = [str(e)]
+        if errors:
+            logging.warning("%s is NOT a valid cloud optimized GeoTIFF: %s", out_fname, '; '.join(errors))
+        results[out_fname] = errors
+    return results
+
+
+class Manifest(object):
+    """ SQLite record of the conversions into an output folder, keyed by source path
+        A source is converted again if its size, mtime or the conversion options changed,
+        if any of its outputs is missing or invalid, or if its conversion did not finish
+    """
+
+    def __init__(self, output_dir, name=MANIFEST_NAME):
+        self.path = pjoin(output_dir, name)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS conversions ('
+                          'source TEXT PRIMARY KEY, '
+                          'size INTEGER, '
+                          'mtime REAL, '
+                          'options TEXT, '
+                          'status TEXT, '
+                          'outputs TEXT, '
+                          'error TEXT, '
+                          'updated REAL)')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def is_done(self, source, options):
+        """ Return True if source was converted with these options and is unchanged since """
+        row = self.conn.execute('SELECT size, mtime, options, status, outputs FROM conversions WHERE source = ?',
+                                (source,)).fetchone()
+        if row is None:
+            return False
+        size, mtime, key, status, outputs = row
+        stat = os.stat(source)
+        if (size, mtime, key, status) != (stat.st_size, stat.st_mtime, options_key(options), 'done'):
+            return False
+        return all(os.path.isfile(out_fname) for out_fname in json.loads(outputs))
+
+    def start(self, source, options):
+        """ Record that the conversion of source started, it stays 'running' if the run crashes """
+        stat = os.stat(source)
+        self.conn.execute('INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          (source, stat.st_size, stat.st_mtime, options_key(options), 'running', '{}', None,
+                           time.time()))
+        self.conn.commit()
+
+    def finish(self, source, outputs):
+        """ Record the outputs of source and their validation errors, see check_outputs """
+        status = 'invalid' if any(outputs.values()) else 'done'
+        self.conn.execute('UPDATE conversions SET status = ?, outputs = ?, error = NULL, updated = ? '
+                          'WHERE source = ?',
+                          (status, json.dumps(outputs), time.time(), source))
+        self.conn.commit()
+
+    def fail(self, source, error):
+        self.conn.execute('UPDATE conversions SET status = ?, error = ?, updated = ? WHERE source = ?',
+                          ('failed', error, time.time(), source))
+        self.conn.commit()
@@ -0,0 +1,109 @@
+""" Read an uncompressed, stripped GeoTIFF in place instead of copying it
+    When the strips of every plane follow each other in the file, each band is a regular array in
+    the file: the file is mapped with numpy.memmap and every band is a gdal MEM band over the
+    mapping (DATAPOINTER), so the overviews and the COG are read straight from the source, through
+    the page cache, without writing an intermediate copy of it.
+    The strip layout is read with tiff_ifd, without decoding any pixels.
+"""
+import os
+import sys
+import numpy
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+from tiff_ifd import (open_tiff, TIFFError, BITS_PER_SAMPLE, SAMPLES_PER_PIXEL, PLANAR_CONFIG, SAMPLE_FORMAT,
+                      PREDICTOR)
+
+# (SampleFormat, bits per sample): gdal data type name, Int8 is left out as it needs PIXELTYPE=SIGNEDBYTE
+DATA_TYPES = {(1, 8): 'Byte',
+              (1, 16): 'UInt16',
+              (2, 16): 'Int16',
+              (1, 32): 'UInt32',
+              (2, 32): 'Int32',
+              (3, 32): 'Float32',
+              (3, 64): 'Float64'}
+NATIVE_BYTE_ORDER = '<' if sys.byteorder == 'little' else '>'
+
+
+def strip_layout(fname):
+    """ The layout of the bands of fname if they can be mapped, else None:
+        {'xsize', 'ysize', 'dtype': gdal data type name, 'bands': [(byte offset, pixel offset, line offset)]}
+        fname must be uncompressed, stripped, in the byte order of this machine, with the strips of each
+        plane contiguous and in order
+    """
+    try:
+        tiff = open_tiff(fname)
+    except (TIFFError, OSError):
+        return None
+    try:
+        ifd = tiff.main
+        if ifd.compression != 1 or ifd.is_tiled or ifd.value(PREDICTOR, 1) != 1:
+            return None
+        samples = ifd.value(SAMPLES_PER_PIXEL, 1)
+        bits = set(ifd.values(BITS_PER_SAMPLE)) if ifd.has(BITS_PER_SAMPLE) else {1}
+        sample_formats = set(ifd.values(SAMPLE_FORMAT)) if ifd.has(SAMPLE_FORMAT) else {1}
+        if len(bits) != 1 or len(sample_formats) != 1:
+            return None
+        item_size = max(bits) // 8
+        dtype = DATA_TYPES.get((sample_formats.pop(), bits.pop()))
+        if dtype is None:
+            return None
+        if item_size > 1 and tiff.byte_order != NATIVE_BYTE_ORDER:
+            return None
+
+        xsize, ysize = ifd.width, ifd.height
+        planar = ifd.value(PLANAR_CONFIG, 1)
+        pixel_offset = samples * item_size if planar == 1 else item_size
+        line_offset = xsize * pixel_offset
+        rows_per_strip = ifd.block_size[1]
+        strips = -(-ysize // rows_per_strip)
+        planes = 1 if planar == 1 else samples
+        offsets = ifd.block_offsets()
+        byte_counts = ifd.block_byte_counts()
+        if len(offsets) < strips * planes or len(byte_counts) < strips * planes:
+            return None
+        file_size = os.path.getsize(fname)
+        plane_offsets = []
+        for plane in range(planes):
+            first = offsets[plane * strips]
+            for strip in range(strips):
+                rows = min(rows_per_strip, ysize - strip * rows_per_strip)
+                index = plane * strips + strip
+                if offsets[index] != first + strip * rows_per_strip * line_offset or \
+                        byte_counts[index] < rows * line_offset:
+                    return None
+            if first + ysize * line_offset > file_size:
+                return None
+            plane_offsets.append(first)
+        if planar == 1:
+            bands = [(plane_offsets[0] + sample * item_size, pixel_offset, line_offset) for sample in range(samples)]
+        else:
+            bands = [(offset, pixel_offset, line_offset) for offset in plane_offsets]
+        return {'xsize': xsize, 'ysize': ysize, 'dtype': dtype, 'bands': bands}
+    finally:
+        tiff.reader.close()
+
+
+def mapped_dataset(fname, band=None):
+    """ A gdal MEM dataset whose bands (only band if given) are the pixels of fname, mapped in place
+        Return (dataset, mapping), None if fname can not be mapped, see strip_layout.
+        The mapping must outlive the dataset. It is copy on write, so a write to the dataset never
+        reaches fname. The georeferencing and metadata are left to the caller.
+    """
+    if gdal is None:
+        return None
+    layout = strip_layout(fname)
+    if layout is None or (band and band > len(layout['bands'])):
+        return None
+    mapping = numpy.memmap(fname, dtype=numpy.uint8, mode='c')
+    address = mapping.ctypes.data
+    datatype = gdal.GetDataTypeByName(layout['dtype'])
+    ds = gdal.GetDriverByName('MEM').Create('', layout['xsize'], layout['ysize'], 0, datatype)
+    for offset, pixel_offset, line_offset in [layout['bands'][band - 1]] if band else layout['bands']:
+        ds.AddBand(datatype, ['DATAPOINTER={}'.format(address + offset),
+                              'PIXELOFFSET={}'.format(pixel_offset),
+                              'LINEOFFSET={}'.format(line_offset)])
+    return ds, mapping
@@ -0,0 +1,309 @@
+""" Per-file, per-stage metrics of the conversions
+
+    In a worker, run_tasks starts a FileMetrics for every source and the conversion code marks
+    its stages with `with stage('name'):`. A stage records its wall time, CPU time (of this
+    process and of the gdal command line tools it ran), the bytes read and written by this process
+    (from /proc/self/io, so not those of the command line tools) and the peak RSS at its end.
+    A stage entered several times for one source, e.g. once per band, is summed.
+
+    In the main process a MetricsLog writes every record as a JSON line, and aggregates them into
+    the end of run report: percentiles of the stage times and throughput in source MB/s.
+    It can also write a Prometheus textfile for the node exporter's textfile collector.
+    With the stage gates of a cog_scheduler.Scheduler, a stage first waits for a slot of its kind,
+    the seconds waited are recorded as the 'wait' of the stage, outside of its wall time.
+"""
+from os.path import basename
+import os
+import sys
+import json
+import math
+import time
+import socket
+import logging
+import resource
+from contextlib import contextmanager
+
+import click
+
+# The FileMetrics of the source being converted by this process
+_current = None
+# The cog_scheduler.StageGates of this process, and whether a stage holds one of their slots
+_gates = None
+_gated = False
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _io_bytes():
+    """ (bytes read, bytes written) by this process, including page cache hits, None if unknown """
+    try:
+        with open('/proc/self/io') as fp:
+            counters = dict(line.split(':', 1) for line in fp)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss_mb():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.0
+
+
+class FileMetrics(object):
+    """ The stages of the conversion of one source """
+
+    def __init__(self, source):
+        self.source = source
+        self.stages = {}
+        self.start = time.perf_counter()
+        self.start_cpu = _cpu_seconds()
+        try:
+            self.input_bytes = os.path.getsize(source)
+        except OSError:
+            self.input_bytes = None
+
+    def add(self, name, wall, cpu, read_bytes, write_bytes, wait=None):
+        entry = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                              'read_bytes': 0, 'write_bytes': 0})
+        entry['calls'] += 1
+        if wait is not None:
+            entry['wait'] = entry.get('wait', 0.0) + wait
+        entry['wall'] += wall
+        entry['cpu'] += cpu
+        if read_bytes is not None:
+            entry['read_bytes'] += read_bytes
+            entry['write_bytes'] += write_bytes
+        entry['peak_rss_mb'] = _peak_rss_mb()
+
+    def finish(self, outputs=()):
+        """ The record of the source as a dictionary, outputs are the file names written """
+        output_bytes = sum(os.path.getsize(fname) for fname in outputs if os.path.exists(fname))
+        return {'source': self.source,
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'time': time.time(),
+                'wall': time.perf_counter() - self.start,
+                'cpu': _cpu_seconds() - self.start_cpu,
+                'peak_rss_mb': _peak_rss_mb(),
+                'input_bytes': self.input_bytes,
+                'output_bytes': output_bytes,
+                'ratio': output_bytes / float(self.input_bytes) if self.input_bytes else None,
+                'outputs': len(outputs),
+                'stages': self.stages}
+
+
+def start(source):
+    """ Start recording the stages of source in this process """
+    global _current
+    _current = FileMetrics(source)
+
+
+def finish(outputs=()):
+    """ Stop recording and return the record of the current source, None if none was started """
+    global _current
+    metrics, _current = _current, None
+    return metrics.finish(outputs) if metrics is not None else None
+
+
+def set_gates(gates):
+    """ Make the stages of this process wait for a slot of gates, a cog_scheduler.StageGates, None for no gates """
+    global _gates
+    _gates = gates
+
+
+@contextmanager
+def stage(name):
+    """ Record the time spent in the block as stage name of the current source """
+    global _gated
+    # A stage run inside another one is covered by the slot of the outer stage
+    wait = _gates.acquire(name) if _gates is not None and not _gated else None
+    if wait is None:
+        with _recorded(name):
+            yield
+        return
+    _gated = True
+    try:
+        with _recorded(name, wait):
+            yield
+    finally:
+        _gated = False
+        _gates.release(name)
+
+
+@contextmanager
+def _recorded(name, wait=None):
+    if _current is None:
+        yield
+        return
+    metrics = _current
+    start_wall = time.perf_counter()
+    start_cpu = _cpu_seconds()
+    start_read, start_write = _io_bytes()
+    try:
+        yield
+    finally:
+        read_bytes, write_bytes = _io_bytes()
+        if start_read is not None and read_bytes is not None:
+            read_bytes, write_bytes = read_bytes - start_read, write_bytes - start_write
+        else:
+            read_bytes = write_bytes = None
+        metrics.add(name, time.perf_counter() - start_wall, _cpu_seconds() - start_cpu, read_bytes, write_bytes,
+                    wait)
+
+
+def percentile(values, q):
+    """ Nearest rank percentile of the sorted list values, q between 0 and 1 """
+    if not values:
+        return None
+    return values[min(len(values), max(1, int(math.ceil(q * len(values))))) - 1]
+
+
+class MetricsLog(object):
+    """ Collect the records of a run, optionally appending them as JSON lines to fname """
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.fp = open(fname, 'a', buffering=1) if fname else None
+        self.records = []
+
+    def add(self, record):
+        if record is None:
+            return
+        if self.fp is not None:
+            self.fp.write(json.dumps(record, sort_keys=True) + '\n')
+        # Keep what the report needs, not the whole record
+        self.records.append({'wall': record['wall'],
+                             'cpu': record['cpu'],
+                             'peak_rss_mb': record['peak_rss_mb'],
+                             'input_bytes': record['input_bytes'] or 0,
+                             'output_bytes': record['output_bytes'],
+                             'stages': {name: (entry['wall'], entry['cpu'], entry['read_bytes'],
+                                               entry['write_bytes'])
+                                        for name, entry in record['stages'].items()}})
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def summary(self):
+        """ Aggregate the records: totals, and per stage (and 'total') the percentiles of the wall time,
+            the CPU/wall ratio and the throughput in source MB per second of wall time
+        """
+        input_bytes = sum(r['input_bytes'] for r in self.records)
+        output_bytes = sum(r['output_bytes'] for r in self.records)
+        stages = {}
+        for r in self.records:
+            rows = dict(r['stages'], total=(r['wall'], r['cpu'], None, None))
+            for name, (wall, cpu, read_bytes, write_bytes) in rows.items():
+                entry = stages.setdefault(name, {'walls': [], 'cpu': 0.0, 'input_bytes': 0,
+                                                 'read_bytes': 0, 'write_bytes': 0})
+                entry['walls'].append(wall)
+                entry['cpu'] += cpu
+                entry['input_bytes'] += r['input_bytes']
+                entry['read_bytes'] += read_bytes or 0
+                entry['write_bytes'] += write_bytes or 0
+        for entry in stages.values():
+            walls = sorted(entry.pop('walls'))
+            entry['files'] = len(walls)
+            entry['wall'] = sum(walls)
+            entry['max'] = walls[-1]
+            for q in QUANTILES:
+                entry['p{:g}'.format(q * 100)] = percentile(walls, q)
+            entry['cpu_ratio'] = entry['cpu'] / entry['wall'] if entry['wall'] else None
+            entry['mb_per_s'] = entry['input_bytes'] / 1e6 / entry['wall'] if entry['wall'] else None
+        return {'files': len(self.records),
+                'input_bytes': input_bytes,
+                'output_bytes': output_bytes,
+                'ratio': output_bytes / float(input_bytes) if input_bytes else None,
+                'peak_rss_mb': max([r['peak_rss_mb'] for r in self.records] or [0]),
+                'stages': stages}
+
+    def report(self):
+        """ Log the summary as a table, one row per stage """
+        summary = self.summary()
+        if not summary['files']:
+            return summary
+        logging.info("Metrics of %i files: %.1f MB in, %.1f MB out (ratio %.3f), peak RSS %.0f MB",
+                     summary['files'], summary['input_bytes'] / 1e6, summary['output_bytes'] / 1e6,
+                     summary['ratio'] or 0, summary['peak_rss_mb'])
+        logging.info('%-12s %6s %10s %8s %8s %8s %8s %6s %8s %10s %10s', 'stage', 'files', 'total s', 'p50 s',
+                     'p90 s', 'p99 s', 'max s', 'cpu', 'MB/s', 'read MB', 'write MB')
+        names = sorted(summary['stages'], key=lambda name: (name == 'total', -summary['stages'][name]['wall']))
+        for name in names:
+            entry = summary['stages'][name]
+            logging.info('%-12s %6i %10.2f %8.2f %8.2f %8.2f %8.2f %6.2f %8.1f %10.1f %10.1f',
+                         name, entry['files'], entry['wall'], entry['p50'], entry['p90'], entry['p99'],
+                         entry['max'], entry['cpu_ratio'] or 0, entry['mb_per_s'] or 0,
+                         entry['read_bytes'] / 1e6, entry['write_bytes'] / 1e6)
+        return summary
+
+    def write_prometheus(self, fname, job='cog_conversion'):
+        """ Write the summary in the Prometheus text format, atomically as the textfile collector expects """
+        summary = self.summary()
+        lines = ['# HELP cog_files_total Files converted in the last run',
+                 '# TYPE cog_files_total gauge',
+                 'cog_files_total{{job="{}"}} {}'.format(job, summary['files']),
+                 '# HELP cog_bytes_total Bytes read from the sources and written as outputs in the last run',
+                 '# TYPE cog_bytes_total gauge',
+                 'cog_bytes_total{{job="{}",direction="in"}} {}'.format(job, summary['input_bytes']),
+                 'cog_bytes_total{{job="{}",direction="out"}} {}'.format(job, summary['output_bytes']),
+                 '# HELP cog_peak_rss_megabytes Peak resident memory of a conversion process',
+                 '# TYPE cog_peak_rss_megabytes gauge',
+                 'cog_peak_rss_megabytes{{job="{}"}} {}'.format(job, summary['peak_rss_mb']),
+                 '# HELP cog_stage_seconds Wall time of a conversion stage per file',
+                 '# TYPE cog_stage_seconds summary']
+        for name, entry in sorted(summary['stages'].items()):
+            labels = 'job="{}",stage="{}"'.format(job, name)
+            for q in QUANTILES:
+                lines.append('cog_stage_seconds{{{},quantile="{:g}"}} {}'.format(labels, q,
+                                                                                  entry['p{:g}'.format(q * 100)]))
+            lines.append('cog_stage_seconds_sum{{{}}} {}'.format(labels, entry['wall']))
+            lines.append('cog_stage_seconds_count{{{}}} {}'.format(labels, entry['files']))
+        lines += ['# HELP cog_stage_cpu_seconds_total CPU time of a conversion stage',
+                  '# TYPE cog_stage_cpu_seconds_total gauge']
+        for name, entry in sorted(summary['stages'].items()):
+            lines.append('cog_stage_cpu_seconds_total{{job="{}",stage="{}"}} {}'.format(job, name, entry['cpu']))
+        lines += ['# HELP cog_last_run_timestamp_seconds End of the last run',
+                  '# TYPE cog_last_run_timestamp_seconds gauge',
+                  'cog_last_run_timestamp_seconds{{job="{}"}} {}'.format(job, time.time())]
+        temp_fname = fname + '.tmp'
+        with open(temp_fname, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        os.replace(temp_fname, fname)
+
+
+@click.command(help="\b Aggregate the metrics JSON lines written by geotiff-cog.py/netcdf-cog.py --metrics,"
+                    " e.g. those of every node of a queue run, into one report.")
+@click.argument('fnames', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--prometheus', default=None, help="Also write the summary to this Prometheus textfile",
+              type=click.Path(dir_okay=False, writable=True))
+@click.option('--json', 'json_fname', default=None, help="Also write the summary to this JSON file",
+              type=click.Path(dir_okay=False, writable=True))
+def main(fnames, prometheus, json_fname):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    log = MetricsLog()
+    for fname in fnames:
+        with open(fname) as fp:
+            for line in fp:
+                if line.strip():
+                    log.add(json.loads(line))
+    if not log.records:
+        logging.error("No metrics in %s", ', '.join(basename(fname) for fname in fnames))
+        sys.exit(1)
+    summary = log.report()
+    if prometheus:
+        log.write_prometheus(prometheus)
+    if json_fname:
+        with open(json_fname, 'w') as fp:
+            json.dump(summary, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
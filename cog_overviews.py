@@ -0,0 +1,123 @@
+""" Build the overviews of a GTiff with NumPy instead of gdaladdo
+    The list of levels follows from the raster size, and every level is reduced by 2 from the
+    previous one, window by window, so memory stays bounded whatever the raster size.
+    Pixels equal to the band's nodata value (or NaN) are left out of the reductions.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+
+RESAMPLING = ('average', 'mode', 'nearest')
+BUILDERS = ('numpy', 'gdal')
+
+
+def overview_levels(xsize, ysize, blocksize=512):
+    """ Overview factors 2, 4, 8 ... until the smallest overview fits in one block
+        A raster of 512 pixels or more always gets at least one overview, as validate() expects
+    """
+    levels = []
+    factor = 2
+    size = max(xsize, ysize)
+    while size >= blocksize and (not levels or size > blocksize):
+        levels.append(factor)
+        factor = factor * 2
+        size = -(-size // 2)
+    return levels
+
+
+def _valid_mask(data, nodata):
+    valid = numpy.ones(data.shape, dtype=bool)
+    if nodata is not None:
+        valid &= data != nodata
+    if data.dtype.kind == 'f':
+        valid &= ~numpy.isnan(data)
+    return valid
+
+
+def _windows(data, valid):
+    """ The four pixels of each 2x2 window as arrays of shape (4, rows, cols), padding odd edges """
+    rows, cols = -(-data.shape[0] // 2), -(-data.shape[1] // 2)
+    pad = ((0, rows * 2 - data.shape[0]), (0, cols * 2 - data.shape[1]))
+    data = numpy.pad(data, pad, mode='edge')
+    valid = numpy.pad(valid, pad, mode='constant', constant_values=False)
+    stack = [data[dy::2, dx::2] for dy in (0, 1) for dx in (0, 1)]
+    valid_stack = [valid[dy::2, dx::2] for dy in (0, 1) for dx in (0, 1)]
+    return numpy.stack(stack), numpy.stack(valid_stack)
+
+
+def reduce_average(data, nodata):
+    values, valid = _windows(data, _valid_mask(data, nodata))
+    count = valid.sum(axis=0)
+    total = numpy.where(valid, values, 0).sum(axis=0, dtype=numpy.float64)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    if data.dtype.kind in 'iu':
+        mean = numpy.round(mean)
+    fill = nodata if nodata is not None else 0
+    return numpy.where(count > 0, mean, fill).astype(data.dtype)
+
+
+def reduce_mode(data, nodata):
+    values, valid = _windows(data, _valid_mask(data, nodata))
+    # For each of the 4 pixels, how many valid pixels of its window have the same value
+    counts = numpy.stack([((values == values[i]) & valid).sum(axis=0) for i in range(4)])
+    counts = numpy.where(valid, counts, -1)
+    choice = counts.argmax(axis=0)
+    mode = numpy.take_along_axis(values, choice[numpy.newaxis], axis=0)[0]
+    fill = nodata if nodata is not None else 0
+    return numpy.where(valid.any(axis=0), mode, fill).astype(data.dtype)
+
+
+def reduce_nearest(data, nodata):
+    # The pixel nearest to the centre of the window, like gdal's nearest with a factor of 2
+    rows = numpy.minimum(numpy.arange(-(-data.shape[0] // 2)) * 2 + 1, data.shape[0] - 1)
+    cols = numpy.minimum(numpy.arange(-(-data.shape[1] // 2)) * 2 + 1, data.shape[1] - 1)
+    return data[numpy.ix_(rows, cols)]
+
+
+REDUCERS = {'average': reduce_average, 'mode': reduce_mode, 'nearest': reduce_nearest}
+
+
+def _reduce_band(src_band, dst_band, reducer, nodata, blocksize, executor=None, threads=1):
+    """ Fill dst_band from src_band at half its resolution, one window of blocksize x blocksize
+        output pixels at a time
+        With an executor, batches of threads windows are reduced concurrently, the reads and writes
+        through gdal stay in this thread
+    """
+    windows = [(x, y) for y in range(0, dst_band.YSize, blocksize) for x in range(0, dst_band.XSize, blocksize)]
+    for start in range(0, len(windows), threads):
+        batch = []
+        for x, y in windows[start:start + threads]:
+            width = min(blocksize * 2, src_band.XSize - x * 2)
+            height = min(blocksize * 2, src_band.YSize - y * 2)
+            batch.append(src_band.ReadAsArray(x * 2, y * 2, width, height))
+        if executor is not None:
+            reduced_batch = executor.map(reducer, batch, [nodata] * len(batch))
+        else:
+            reduced_batch = [reducer(data, nodata) for data in batch]
+        for (x, y), reduced in zip(windows[start:start + threads], reduced_batch):
+            reduced = reduced[:dst_band.YSize - y, :dst_band.XSize - x]
+            dst_band.WriteArray(reduced, x, y)
+
+
+def build_overviews(ds, levels, resampling='average', blocksize=512, threads=1):
+    """ Create the overviews of levels (successive powers of 2) in ds, an updatable gdal dataset,
+        each computed from the previous level
+        threads <int>: Number of windows reduced concurrently, NumPy releases the GIL in the reductions
+    """
+    if ds.BuildOverviews('NONE', levels) != 0:
+        raise RuntimeError("Unable to create overviews of {}".format(ds.GetDescription()))
+    reducer = REDUCERS[resampling]
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+    try:
+        for index in range(1, ds.RasterCount + 1):
+            band = ds.GetRasterBand(index)
+            nodata = band.GetNoDataValue()
+            previous = band
+            for level in range(band.GetOverviewCount()):
+                overview = band.GetOverview(level)
+                _reduce_band(previous, overview, reducer, nodata, blocksize, executor, threads)
+                overview.FlushCache()
+                previous = overview
+    finally:
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,121 @@
+import logging
+import resource
+from os.path import basename
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import cog_metrics
+
+
+class RunSummary(object):
+    """ Keep track of the files converted and failed during a run """
+
+    def __init__(self):
+        self.converted = []
+        self.failed = []
+        self.on_done = None
+        self.on_failed = None
+        self.metrics = None
+        self.scheduler = None
+
+    def add_converted(self, fname, result):
+        if self.metrics is not None:
+            result, record = result
+            self.metrics.add(record)
+            if self.scheduler is not None:
+                self.scheduler.observe(record)
+        self.converted.append(fname)
+        if self.on_done is not None:
+            self.on_done(fname, result)
+
+    def add_failed(self, fname, error):
+        self.failed.append((fname, error))
+        if self.on_failed is not None:
+            self.on_failed(fname, error)
+
+    def log(self):
+        logging.info("Conversion finished: %i converted, %i failed", len(self.converted), len(self.failed))
+        logging.info("Peak RSS %.0f MB, of a worker process %.0f MB",
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                     resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0)
+        for fname, error in self.failed:
+            logging.error("Failed to convert %s: %s", fname, error)
+
+
+def _measured(func, fname, *args):
+    """ Call func(*args) recording the metrics of fname, return the result and the metrics record
+        A result that is a dictionary is taken as {output file name: ...}, for the output sizes
+    """
+    cog_metrics.start(fname)
+    try:
+        result = func(*args)
+    except BaseException:
+        cog_metrics.finish()
+        raise
+    return result, cog_metrics.finish(result if isinstance(result, dict) else ())
+
+
+def _measured_tasks(func, tasks):
+    for fname, args in tasks:
+        yield fname, (func, fname) + tuple(args)
+
+
+def run_tasks(func, tasks, workers=1, max_in_flight=None, on_done=None, on_failed=None, metrics=None,
+              scheduler=None, summary=None):
+    """ Call func(*args) for every (fname, args) pair in tasks
+        workers <int>: Number of worker processes; 1 converts in this process
+        max_in_flight <int>: Upper bound on the submitted but unfinished tasks,
+                             so a walk over millions of files is not queued up front
+        on_done(fname, result), on_failed(fname, error): Called in this process as tasks finish
+        metrics <cog_metrics.MetricsLog>: Record the stages of every converted file into metrics
+        scheduler <cog_scheduler.Scheduler>: Gate the stages of the workers with its slots and tune
+                                             them from the metrics of the converted files
+        summary <RunSummary>: Add to the summary of an earlier call, e.g. across the rounds of a work queue
+        A failure converting one file is logged and recorded in the summary,
+        it does not stop the conversion of the other files.
+    """
+    summary = summary if summary is not None else RunSummary()
+    summary.on_done = on_done
+    summary.on_failed = on_failed
+    if scheduler is not None and workers > 1:
+        # The scheduler tunes the slots from the metrics records
+        metrics = metrics if metrics is not None else cog_metrics.MetricsLog()
+        summary.scheduler = scheduler
+    summary.metrics = metrics
+    if metrics is not None:
+        tasks = _measured_tasks(func, tasks)
+        func = _measured
+    if workers <= 1:
+        for fname, args in tasks:
+            try:
+                result = func(*args)
+            except Exception as e:
+                logging.exception("Error converting %s", fname)
+                summary.add_failed(fname, str(e))
+            else:
+                summary.add_converted(fname, result)
+        return summary
+
+    max_in_flight = max_in_flight or workers * 2
+    in_flight = {}
+    gates = summary.scheduler.gates if summary.scheduler is not None else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=cog_metrics.set_gates, initargs=(gates,)) as executor:
+        for fname, args in tasks:
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                _collect(done, in_flight, summary)
+            in_flight[executor.submit(func, *args)] = fname
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            _collect(done, in_flight, summary)
+    return summary
+
+
+def _collect(done, in_flight, summary):
+    for future in done:
+        fname = in_flight.pop(future)
+        error = future.exception()
+        if error is None:
+            summary.add_converted(fname, future.result())
+            logging.info("Converted %s (%i done)", basename(fname), len(summary.converted))
+        else:
+            logging.error("Error converting %s: %s", fname, error)
+            summary.add_failed(fname, str(error))
@@ -0,0 +1,38 @@
+""" Named sets of COG compression options, selected with --profile
+    COMPRESS=[DEFLATE/LZW/ZSTD/LERC_ZSTD]: Set the compression to use. ZSTD and LERC need GDAL >= 2.3
+                                           built with libzstd.
+    ZLEVEL=[1-9]: Level of DEFLATE compression. 9 is best and slowest, 1 is least compression and fastest.
+    ZSTD_LEVEL=[1-22]: Level of ZSTD compression.
+    MAX_Z_ERROR <float>: Maximum error of LERC compression, 0 is lossless.
+    PREDICTOR <int>: Predictor Type (1=default, 2=horizontal differencing, 3=floating point prediction),
+                     chosen from the data type unless the profile sets it
+"""
+
+PROFILES = {
+    'fast': ['COMPRESS=ZSTD', 'ZSTD_LEVEL=1'],
+    'balanced': ['COMPRESS=DEFLATE', 'ZLEVEL=6'],
+    'archive': ['COMPRESS=DEFLATE', 'ZLEVEL=9'],
+    'lzw': ['COMPRESS=LZW'],
+    'zstd': ['COMPRESS=ZSTD', 'ZSTD_LEVEL=9'],
+    'lerc': ['COMPRESS=LERC_ZSTD', 'MAX_Z_ERROR=0', 'PREDICTOR=1'],
+}
+
+# ZLEVEL=9 DEFLATE, what the converters always used
+DEFAULT_PROFILE = 'archive'
+
+
+def predictor_for(dtype):
+    """ Floating point prediction for float data, horizontal differencing for integer data
+        dtype is a gdal data type name, e.g. 'Int16' or 'Float32'
+    """
+    if 'Float' in dtype:
+        return 3
+    return 2
+
+
+def profile_options(profile, dtype):
+    """ The compression creation options of profile for data of type dtype """
+    options = list(PROFILES[profile])
+    if not any(option.startswith('PREDICTOR=') for option in options):
+        options.append('PREDICTOR={}'.format(predictor_for(dtype)))
+    return options
@@ -0,0 +1,93 @@
+""" Write outputs so that a rerun producing the same bytes leaves them untouched
+
+    An output is written to a hidden temporary file next to it, hashed, and only moved over the
+    output when the hash differs from the one in the output's <name>.sha256 sidecar (sha256sum
+    format). An unchanged output keeps its mtime, so `aws s3 sync` and the uploader skip it.
+    The sidecar also records the size, inode and mtime of the file it was written for, as a comment
+    line that sha256sum -c ignores. A sidecar that does not match the file any more is not trusted.
+"""
+from os.path import join as pjoin, basename, dirname, exists
+import os
+import hashlib
+
+HASH_SUFFIX = '.sha256'
+CHUNK_SIZE = 1024 * 1024
+
+
+def temp_name(fname):
+    """ The temporary file of fname, hidden and with the same extension so gdal picks the same driver """
+    return pjoin(dirname(fname), '.part_' + basename(fname))
+
+
+def file_sha256(fname):
+    """ The hex sha256 of the content of fname, read in chunks """
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stamp(fname):
+    """ The size, inode and mtime of fname, as recorded in its sidecar """
+    stat = os.stat(fname)
+    return '# size={} inode={} mtime_ns={}'.format(stat.st_size, stat.st_ino, stat.st_mtime_ns)
+
+
+def read_sidecar(fname):
+    """ The sha256 recorded for fname, None if there is none or fname was replaced or changed since """
+    sidecar = fname + HASH_SUFFIX
+    if not exists(sidecar) or not exists(fname):
+        return None
+    with open(sidecar) as fp:
+        lines = fp.read().splitlines()
+    if len(lines) < 2 or lines[1] != _stamp(fname):
+        return None
+    return lines[0].split(' ', 1)[0].strip() or None
+
+
+def write_sidecar(fname, digest):
+    """ Record digest as the sha256 of fname, as it is now """
+    temp_fname = temp_name(fname + HASH_SUFFIX)
+    with open(temp_fname, 'w') as fp:
+        fp.write('{}  {}\n{}\n'.format(digest, basename(fname), _stamp(fname)))
+    os.replace(temp_fname, fname + HASH_SUFFIX)
+
+
+def remove_sidecar(fname):
+    """ Forget the sha256 of fname, e.g. once it was replaced without going through publish """
+    if exists(fname + HASH_SUFFIX):
+        os.remove(fname + HASH_SUFFIX)
+
+
+def content_sha256(fname):
+    """ The sha256 of fname, from its sidecar if it is up to date """
+    return read_sidecar(fname) or file_sha256(fname)
+
+
+def publish(temp_fname, fname):
+    """ Move temp_fname to fname, unless fname already has the same content
+        Return True if fname changed
+    """
+    digest = file_sha256(temp_fname)
+    if read_sidecar(fname) == digest:
+        os.remove(temp_fname)
+        return False
+    os.replace(temp_fname, fname)
+    write_sidecar(fname, digest)
+    return True
+
+
+def publish_bytes(fname, data):
+    """ Write data to fname unless fname already has the same content, hashing data as it is written
+        Return True if fname changed
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    if read_sidecar(fname) == digest:
+        return False
+    temp_fname = temp_name(fname)
+    with open(temp_fname, 'wb') as fp:
+        fp.write(data)
+    os.replace(temp_fname, fname)
+    write_sidecar(fname, digest)
+    return True
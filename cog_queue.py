@@ -0,0 +1,166 @@
+""" Work queue on a shared filesystem, so any number of nodes can convert one collection
+
+    plan: every source becomes a task file in <queue>/tasks, named by rank of size so the largest
+          sources are claimed first
+    work: a worker claims a task by renaming it into <queue>/claimed, an atomic operation on a
+          POSIX filesystem so only one worker gets it, and moves it to <queue>/done or
+          <queue>/failed when finished. All the workers take from the same pool, a fast node
+          simply takes more tasks.
+    lease: while a worker holds a task it touches the claimed file every lease/4 seconds. A claimed
+           task that has not been touched for lease seconds belongs to a crashed worker and is
+           put back in <queue>/tasks by the next worker that looks for work.
+    wait: once the task list is empty a worker finishes the tasks it holds, then waits while other
+          workers hold tasks and converts again whatever is reclaimed. It never waits while it holds
+          tasks, so the workers can not end up waiting on each other.
+"""
+from os.path import join as pjoin
+import os
+import json
+import time
+import socket
+import logging
+import threading
+
+DEFAULT_LEASE = 900
+
+
+class WorkQueue(object):
+
+    def __init__(self, root, lease=DEFAULT_LEASE):
+        self.root = root
+        self.lease = lease
+        self.dirs = {name: pjoin(root, name) for name in ('tasks', 'claimed', 'done', 'failed')}
+        for path in self.dirs.values():
+            os.makedirs(path, exist_ok=True)
+        self.worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.held = {}
+        self._pending = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _path(self, state, name):
+        return pjoin(self.dirs[state], name)
+
+    def plan(self, sources):
+        """ Write a task for every (source, size) pair, largest first. Return the number of tasks """
+        if self._list('tasks') or self._list('claimed'):
+            raise RuntimeError("The queue {} already has tasks to do".format(self.root))
+        sources = sorted(sources, key=lambda source: -source[1])
+        for rank, (source, size) in enumerate(sources):
+            name = '{:09d}.json'.format(rank)
+            temp_path = self._path('tasks', '.' + name)
+            with open(temp_path, 'w') as fp:
+                json.dump({'source': source, 'size': size}, fp)
+            os.rename(temp_path, self._path('tasks', name))
+        return len(sources)
+
+    def _list(self, state):
+        return sorted(name for name in os.listdir(self.dirs[state]) if name.endswith('.json'))
+
+    def claim(self):
+        """ Claim the next task and return its source file name, or None when no task is left to claim
+            It does not wait for the tasks held by other workers, see wait
+        """
+        while True:
+            if not self._pending:
+                self.reclaim()
+                self._pending = self._list('tasks')
+            if not self._pending:
+                return None
+            name = self._pending.pop(0)
+            try:
+                os.rename(self._path('tasks', name), self._path('claimed', name))
+            except FileNotFoundError:
+                # Claimed by another worker
+                continue
+            os.utime(self._path('claimed', name))
+            with open(self._path('claimed', name)) as fp:
+                source = json.load(fp)['source']
+            with self._lock:
+                self.held[source] = name
+            logging.info("%s claimed %s", self.worker, source)
+            return source
+
+    def wait(self):
+        """ Wait while other workers hold tasks, so their tasks can be reclaimed if they crash
+            Return True when a task is back in the task list, False when no other worker holds a task
+            Only call it once the tasks this worker claimed are finished: a worker waiting here
+            while it holds tasks would keep them alive, and other workers may wait on them
+        """
+        while True:
+            self.reclaim()
+            if self._list('tasks'):
+                return True
+            with self._lock:
+                held = set(self.held.values())
+            if not [name for name in self._list('claimed') if name not in held]:
+                return False
+            time.sleep(min(self.lease / 10.0, 60))
+
+    def sources(self):
+        """ Claim tasks one after the other, as a generator of source file names, until none is left
+            The held tasks are only kept alive between start_heartbeat and stop_heartbeat
+        """
+        while True:
+            source = self.claim()
+            if source is None:
+                return
+            yield source
+
+    def _finish(self, source, state, error=None):
+        with self._lock:
+            name = self.held.pop(source, None)
+        if name is None:
+            return
+        if error is not None:
+            with open(self._path(state, name[:-len('.json')] + '.error'), 'w') as fp:
+                fp.write('{}\n{}\n'.format(self.worker, error))
+        try:
+            os.rename(self._path('claimed', name), self._path(state, name))
+        except FileNotFoundError:
+            logging.warning("Task of %s was reclaimed by another worker", source)
+
+    def complete(self, source, result=None):
+        self._finish(source, 'done')
+
+    def fail(self, source, error):
+        self._finish(source, 'failed', error)
+
+    def reclaim(self):
+        """ Put the claimed tasks whose lease expired back in the task list """
+        now = time.time()
+        with self._lock:
+            held = set(self.held.values())
+        for name in self._list('claimed'):
+            if name in held:
+                continue
+            try:
+                if now - os.stat(self._path('claimed', name)).st_mtime < self.lease:
+                    continue
+                os.rename(self._path('claimed', name), self._path('tasks', name))
+            except FileNotFoundError:
+                continue
+            logging.warning("Reclaimed task %s, its lease expired", name)
+
+    def _beat(self):
+        while not self._stop.wait(self.lease / 4.0):
+            with self._lock:
+                names = list(self.held.values())
+            for name in names:
+                try:
+                    os.utime(self._path('claimed', name))
+                except FileNotFoundError:
+                    pass
+
+    def start_heartbeat(self):
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        """ Stop touching the held tasks, once the last of them is finished """
+        self._stop.set()
+
+    def counts(self):
+        return {state: len(self._list(state)) for state in self.dirs}
@@ -0,0 +1,106 @@
+""" Find the files to convert with os.scandir, with include/exclude globs and a persisted index
+
+    The index records, for every directory, its mtime, its files and its subdirectories. On the
+    next scan a directory whose mtime did not change is not listed again: adding, removing or
+    renaming an entry changes the mtime of its directory. The file sizes in the index can be stale
+    if a file was rewritten in place, the manifest stats the sources it converts anyway.
+"""
+from os.path import join as pjoin, relpath
+import os
+import json
+import fnmatch
+import logging
+
+INDEX_NAME = '.cog_scan_index.json'
+
+
+class ScanIndex(object):
+    """ The directory listings of the last scan, saved as JSON """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.old = {}
+        self.new = {}
+        if os.path.isfile(fname):
+            try:
+                with open(fname) as fp:
+                    self.old = json.load(fp)
+            except ValueError:
+                logging.warning("Ignoring the corrupt scan index %s", fname)
+
+    def get(self, path, mtime):
+        entry = self.old.get(path)
+        if entry is not None and entry['mtime'] == mtime:
+            return entry
+        return None
+
+    def put(self, path, entry):
+        self.new[path] = entry
+
+    def save(self, root):
+        """ Write the listings of this scan of root, the directories under root that were not visited
+            are dropped, the listings of other trees are kept
+        """
+        listings = {path: entry for path, entry in self.old.items()
+                    if path != root and not path.startswith(root.rstrip('/') + '/')}
+        listings.update(self.new)
+        os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+        temp_fname = self.fname + '.tmp'
+        with open(temp_fname, 'w') as fp:
+            json.dump(listings, fp)
+        os.replace(temp_fname, self.fname)
+
+
+def _matches(name, rel_path, patterns):
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel_path, pattern) for pattern in patterns)
+
+
+def _list_dir(path, sizes):
+    files = []
+    dirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif entry.is_file():
+                files.append([entry.name, entry.stat().st_size if sizes else None])
+    files.sort()
+    dirs.sort()
+    return {'files': files, 'dirs': dirs, 'sizes': sizes}
+
+
+def scan(root, include=('*',), exclude=(), index=None, sizes=False):
+    """ Yield (path, size) for the files under root matching an include glob and no exclude glob,
+        depth first in sorted order, as the directories are listed
+        The globs match the file name or the path relative to root, exclude globs also prune directories
+        size is None unless sizes is True, it costs a stat of every file
+        index <ScanIndex>: Reuse the listing of the directories that did not change, and record this scan
+    """
+    stack = [root]
+    try:
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError as e:
+                logging.warning("Unable to scan %s: %s", path, e)
+                continue
+            entry = index.get(path, mtime) if index is not None else None
+            if entry is None or (sizes and not entry['sizes']):
+                entry = _list_dir(path, sizes)
+                entry['mtime'] = mtime
+            if index is not None:
+                index.put(path, entry)
+
+            for name, size in entry['files']:
+                file_path = pjoin(path, name)
+                rel_path = relpath(file_path, root)
+                if _matches(name, rel_path, include) and not _matches(name, rel_path, exclude):
+                    yield file_path, size
+            for name in reversed(entry['dirs']):
+                dir_path = pjoin(path, name)
+                if not _matches(name, relpath(dir_path, root), exclude):
+                    stack.append(dir_path)
+    finally:
+        if index is not None and not stack:
+            index.save(root)
@@ -0,0 +1,161 @@
+""" Scheduling of the conversions of a run, so the workers stay busy until the last file is done
+
+    order: largest_first starts the largest sources first, the run then ends on small files instead
+           of one large file converting alone while the other workers are idle
+    stages: every stage of a conversion (see cog_metrics.stage) is of one kind of STAGE_KINDS: read
+            the source, encode (overviews and compression) or write the outputs. The worker processes
+            share a StageGate per kind, a number of slots that a worker waits on before starting a
+            stage. The encode slots default to the number of cpus, so more workers than cpus only add
+            reads and writes running beside the encoding, not CPU contention; a worker waiting for a
+            slot holds back its next stage, the backpressure on the kinds that are ahead.
+    adapt: the read and write slots are tuned in turns by hill climbing on the throughput of the run,
+           in source MB per second of the files finished in each interval. A turn takes two intervals:
+           a baseline in which no slots change, then a trial after one kind moved its slots by a
+           step. A trial slower than its baseline is reverted and the next step of that kind goes the
+           other way. Only one kind changes in a turn, so a step is judged on its own effect.
+"""
+import os
+import time
+import logging
+import multiprocessing
+
+# The kind of every stage, stages that are not listed are not gated
+STAGE_KINDS = {'inspect': 'read',
+               'read': 'read',
+               'copy': 'read',
+               'map': 'read',
+               'overviews': 'encode',
+               'cog': 'encode',
+               'link': 'write',
+               'publish': 'write',
+               'yaml': 'write',
+               'catalogue': 'write',
+               'validate': 'write'}
+KINDS = ('read', 'encode', 'write')
+# Seconds between two changes of the slots
+DEFAULT_INTERVAL = 30
+# A change of throughput smaller than this fraction is noise
+TOLERANCE = 0.05
+
+
+def largest_first(sources):
+    """ The file names of the (file name, size) pairs of sources, largest first """
+    return [source for source, _ in sorted(sources, key=lambda source: -source[1])]
+
+
+class StageGate(object):
+    """ A number of slots shared by the worker processes, the number can change while they wait """
+
+    def __init__(self, limit):
+        self._condition = multiprocessing.Condition()
+        self._limit = multiprocessing.Value('i', limit, lock=False)
+        self._active = multiprocessing.Value('i', 0, lock=False)
+
+    @property
+    def limit(self):
+        return self._limit.value
+
+    def set_limit(self, limit):
+        with self._condition:
+            self._limit.value = limit
+            self._condition.notify_all()
+
+    def acquire(self):
+        """ Wait for a slot, return the seconds waited """
+        start = time.perf_counter()
+        with self._condition:
+            while self._active.value >= self._limit.value:
+                self._condition.wait()
+            self._active.value += 1
+        return time.perf_counter() - start
+
+    def release(self):
+        with self._condition:
+            self._active.value -= 1
+            self._condition.notify()
+
+
+class StageGates(object):
+    """ The StageGate of every kind, installed in the workers with cog_metrics.set_gates """
+
+    def __init__(self, limits):
+        self.gates = {kind: StageGate(limits[kind]) for kind in KINDS}
+
+    def acquire(self, name):
+        """ Wait for a slot of the kind of stage name, return the seconds waited, None if it is not gated """
+        kind = STAGE_KINDS.get(name)
+        if kind is None:
+            return None
+        return self.gates[kind].acquire()
+
+    def release(self, name):
+        self.gates[STAGE_KINDS[name]].release()
+
+
+class HillClimb(object):
+    """ Move value by one step at a time between low and high, in the direction that raises the throughput """
+
+    def __init__(self, value, low, high):
+        self.value = value
+        self.low = low
+        self.high = high
+        self.step = 1
+        self.previous = value
+
+    def propose(self):
+        """ Take the next step, return the new value """
+        if not self.low <= self.value + self.step <= self.high:
+            self.step = -self.step
+        self.previous = self.value
+        self.value = min(self.high, max(self.low, self.value + self.step))
+        return self.value
+
+    def judge(self, throughput, baseline):
+        """ Keep the last step if throughput did not drop below baseline, else revert it. Return the value """
+        if throughput < baseline * (1 - TOLERANCE):
+            self.value = self.previous
+            self.step = -self.step
+        return self.value
+
+
+class Scheduler(object):
+    """ The stage gates of a run of worker processes, and their tuning from the records of finished files
+        encode_slots <int>: Stages encoding at a time, default the number of cpus
+    """
+
+    def __init__(self, workers, encode_slots=None, interval=DEFAULT_INTERVAL):
+        self.workers = workers
+        self.interval = interval
+        encode_slots = min(workers, encode_slots or os.cpu_count() or 1)
+        start = max(1, workers // 2)
+        self.gates = StageGates({'read': start, 'encode': encode_slots, 'write': start})
+        self.tuners = [('read', HillClimb(start, 1, workers)), ('write', HillClimb(start, 1, workers))]
+        self._turn = 0
+        # Throughput of the interval before the step of the current turn, None while it is measured
+        self._baseline = None
+        self._window_start = time.perf_counter()
+        self._window_bytes = 0
+
+    def observe(self, record):
+        """ Count the source bytes of a finished file, and retune the slots at the end of an interval """
+        if record is None:
+            return
+        self._window_bytes += record['input_bytes'] or 0
+        elapsed = time.perf_counter() - self._window_start
+        if elapsed < self.interval:
+            return
+        throughput = self._window_bytes / 1e6 / elapsed
+        kind, tuner = self.tuners[self._turn % len(self.tuners)]
+        if self._baseline is None:
+            # No slots changed in this interval: it is the baseline of the step taken now
+            self._baseline = throughput
+            self.gates.gates[kind].set_limit(tuner.propose())
+        else:
+            # Only this kind changed in this interval, keep or revert its step and end the turn
+            self.gates.gates[kind].set_limit(tuner.judge(throughput, self._baseline))
+            self._baseline = None
+            self._turn += 1
+        logging.info("Scheduler: %.1f MB/s, slots %s", throughput,
+                     ', '.join('{} {}'.format(name, self.gates.gates[name].limit) for name in KINDS))
+        self._window_start = time.perf_counter()
+        self._window_bytes = 0
@@ -0,0 +1,150 @@
+from os.path import join as pjoin, dirname, relpath
+import os
+import shutil
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cog_publish import content_sha256, read_sidecar, write_sidecar
+
+# Multipart settings for the S3 uploads
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 64 * 1024 * 1024
+
+
+class LocalBackend(object):
+    """ Copy the files into a local folder, a stand-in for the object store """
+
+    def __init__(self, root):
+        self.root = root
+
+    def remote_hash(self, key):
+        """ The sha256 of the uploaded key, None if it was not uploaded """
+        return read_sidecar(pjoin(self.root, key))
+
+    def upload(self, fname, key, digest=None):
+        dest = pjoin(self.root, key)
+        os.makedirs(dirname(dest), exist_ok=True)
+        temp_dest = dest + '.part'
+        shutil.copyfile(fname, temp_dest)
+        os.replace(temp_dest, dest)
+        if digest:
+            write_sidecar(dest, digest)
+
+    def __str__(self):
+        return self.root
+
+
+class S3Backend(object):
+    """ Upload the files to s3://bucket/prefix with boto3, large files as concurrent multipart uploads """
+
+    def __init__(self, bucket, prefix, max_concurrency=4):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = boto3.client('s3')
+        self.config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                     multipart_chunksize=MULTIPART_CHUNKSIZE,
+                                     max_concurrency=max_concurrency)
+
+    def _key(self, key):
+        return self.prefix + '/' + key if self.prefix else key
+
+    def remote_hash(self, key):
+        """ The sha256 the object was uploaded with, None if there is no such object """
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return response.get('Metadata', {}).get('sha256')
+
+    def upload(self, fname, key, digest=None):
+        # The hash is kept in the object metadata, as the ETag of a multipart upload is not an md5 of the content
+        extra_args = {'Metadata': {'sha256': digest}} if digest else None
+        self.client.upload_file(fname, self.bucket, self._key(key), ExtraArgs=extra_args, Config=self.config)
+
+    def __str__(self):
+        return 's3://{}/{}'.format(self.bucket, self.prefix)
+
+
+def get_backend(url):
+    """ s3://bucket/prefix for S3, file:///path or a folder name for a local folder """
+    if url.startswith('s3://'):
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        return S3Backend(bucket, prefix)
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return LocalBackend(os.path.abspath(url))
+
+
+class Uploader(object):
+    """ Upload the files as soon as they are submitted, from a pool of threads
+        The object key is the file path relative to output_dir, as with aws s3 sync
+        A file whose sha256 is the one the object was uploaded with is skipped
+        A failed upload is retried with exponential backoff
+    """
+
+    def __init__(self, backend, output_dir, workers=4, retries=5, backoff=1.0):
+        self.backend = backend
+        self.output_dir = output_dir
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.uploaded = 0
+        self.unchanged = 0
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def submit(self, fnames):
+        """ Upload fnames in order, from one of the threads """
+        self.executor.submit(self._upload_all, fnames)
+
+    def upload_valid(self, outputs):
+        """ Upload the outputs of one source, a dictionary of file name to validation errors,
+            if all of them are valid. The COGs are uploaded first, so a yaml or catalogue
+            is only published once the COGs it refers to are
+        """
+        if any(outputs.values()):
+            logging.warning("Not uploading %s, it has invalid COGs", ', '.join(sorted(outputs)))
+            return
+        self.submit(sorted(outputs, key=lambda fname: not fname.endswith('.tif')))
+
+    def _upload_all(self, fnames):
+        for fname in fnames:
+            if not self._upload(fname, relpath(fname, self.output_dir)):
+                return
+
+    def _upload(self, fname, key):
+        for attempt in range(self.retries + 1):
+            try:
+                digest = content_sha256(fname)
+                if self.backend.remote_hash(key) == digest:
+                    with self._lock:
+                        self.unchanged = self.unchanged + 1
+                    logging.info("Skipped %s, unchanged", key)
+                    return True
+                self.backend.upload(fname, key, digest)
+            except Exception as e:
+                if attempt == self.retries:
+                    logging.error("Failed to upload %s to %s: %s", fname, self.backend, e)
+                    with self._lock:
+                        self.failed.append((fname, str(e)))
+                    return False
+                delay = self.backoff * 2 ** attempt
+                logging.warning("Upload of %s failed (%s), retrying in %.1fs", fname, e, delay)
+                time.sleep(delay)
+            else:
+                with self._lock:
+                    self.uploaded = self.uploaded + 1
+                logging.info("Uploaded %s", key)
+                return True
+
+    def close(self):
+        """ Wait for the submitted uploads to finish """
+        self.executor.shutdown(wait=True)
+        logging.info("Upload finished: %i uploaded, %i unchanged, %i failed", self.uploaded, self.unchanged,
+                     len(self.failed))
@@ -1,20 +1,20 @@
 from os.path import join as pjoin, basename, dirname, exists
-import tempfile
-from subprocess import check_call
-import subprocess
 import click
 import os
+import sys
+import shutil
 import logging
-
-
-def run_command(command, work_dir): 
-    """ 
-    A simple utility to execute a subprocess command. 
-    """ 
-    try:
-        check_call(command, stderr=subprocess.STDOUT, cwd=work_dir)
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError("command '{}' return with error (code {}): {}".format(e.cmd, e.returncode, e.output))
+from cog_pool import run_tasks
+from cog_scheduler import Scheduler, largest_first
+from cog_engine import write_cog, geotiff_layout, default_engine, ENGINES
+from cog_profiles import PROFILES, DEFAULT_PROFILE
+from cog_overviews import RESAMPLING, BUILDERS
+from cog_manifest import Manifest, check_outputs
+from cog_upload import Uploader, get_backend
+from cog_queue import WorkQueue, DEFAULT_LEASE
+from cog_scan import scan, ScanIndex, INDEX_NAME
+from cog_metrics import MetricsLog, stage
+from cog_publish import temp_name, publish, remove_sidecar
 
 
 def check_dir(fname):
@@ -35,79 +35,85 @@ def getfilename(fname, outdir):
     return out_fname
 
 
-def _write_cogtiff(fname, out_fname, outdir):
-    """ Convert the Geotiff to COG using gdal commands
-        Blocksize is 512
-        TILED <boolean>: Switch to tiled format
-        COPY_SRC_OVERVIEWS <boolean>: Force copy of overviews of source dataset
-        COMPRESS=[NONE/DEFLATE]: Set the compression to use. DEFLATE is only available if NetCDF has been compiled with
-                  NetCDF-4 support. NC4C format is the default if DEFLATE compression is used.
-        ZLEVEL=[1-9]: Set the level of compression when using DEFLATE compression. A value of 9 is best,
-                      and 1 is least compression. The default is 1, which offers the best time/compression ratio.
-        BLOCKXSIZE <int>: Tile Width
-        BLOCKYSIZE <int>: Tile/Strip Height
-        PREDICTOR <int>: Predictor Type (1=default, 2=horizontal differencing, 3=floating point prediction)
-        PROFILE <string-select>: possible values: GDALGeoTIFF,GeoTIFF,BASELINE,
+def _source_action(fname, options):
+    """ The cheapest way to a COG of the Geotiff fname, with options['fast_path']:
+        'link': It is already a valid and compressed COG, hard link or copy it unchanged
+        'overviews': It is tiled, build the overviews on a VRT of it and write the COG, without the
+                     intermediate copy
+        'convert': The full conversion, an uncompressed stripped Geotiff is read in place with options['memmap']
+    """
+    if not options.get('fast_path'):
+        return 'convert'
+    with stage('inspect'):
+        layout = geotiff_layout(fname)
+    if layout is None:
+        return 'convert'
+    if not layout['errors'] and layout['compression'] not in (None, 'NONE'):
+        return 'link'
+    if layout['tiled']:
+        return 'overviews'
+    return 'convert'
+
+
+def _link_file(fname, out_fname):
+    """ Hard link fname to out_fname, or copy it across filesystems, replacing out_fname atomically
+        Return True if out_fname changed
     """
-    with tempfile.TemporaryDirectory() as tmpdir:
-        temp_fname = pjoin(tmpdir, basename(fname))
-        
-        env = ['GDAL_DISABLE_READDIR_ON_OPEN=YES',
-               'CPL_VSIL_CURL_ALLOWED_EXTENSIONS=.tif']
-        subprocess.check_call(env, shell=True)
-        
-        # copy to a tempfolder
-        to_cogtif = [
-                     'gdal_translate',
-                     '-of',
-                     'GTIFF',
-                     fname, 
-                     temp_fname]
-        run_command(to_cogtif, tmpdir)
-
-        # Add Overviews
-        # gdaladdo - Builds or rebuilds overview images.
-        # 2, 4, 8,16,32 are levels which is a list of integral overview levels to build.
-        add_ovr = [
-                   'gdaladdo', 
-                   '-r', 
-                   'average',
-                   '--config',
-                   'GDAL_TIFF_OVR_BLOCKSIZE',
-                   '512',
-                   temp_fname, 
-                   '2',
-                   '4', 
-                   '8', 
-                   '16', 
-                   '32'] 
-        run_command(add_ovr, tmpdir)
-
-        # Convert to COG 
-        cogtif = [
-                  'gdal_translate', 
-                  '-co', 
-                  'TILED=YES', 
-                  '-co', 
-                  'COPY_SRC_OVERVIEWS=YES', 
-                  '-co', 
-                  'COMPRESS=DEFLATE',
-                  '-co',
-                  'ZLEVEL=9',
-                  '--config',
-                  'GDAL_TIFF_OVR_BLOCKSIZE',
-                  '512',
-                  '-co',
-                  'BLOCKXSIZE=512',
-                  '-co',
-                  'BLOCKYSIZE=512',
-                  '-co',
-                  'PREDICTOR=1',
-                  '-co',
-                  'PROFILE=GeoTIFF',
-                  temp_fname, 
-                  out_fname] 
-        run_command(cogtif, outdir) 
+    if exists(out_fname) and os.path.samefile(fname, out_fname):
+        return False
+    temp_fname = temp_name(out_fname)
+    if exists(temp_fname):
+        os.remove(temp_fname)
+    try:
+        os.link(fname, temp_fname)
+    except OSError:
+        shutil.copyfile(fname, temp_fname)
+        return publish(temp_fname, out_fname)
+    os.replace(temp_fname, out_fname)
+    # The digest of the previous output does not hold for the linked file, it is hashed when needed
+    remove_sidecar(out_fname)
+    return True
+
+
+def _write_cogtiff(fname, out_fname, options):
+    """ Convert the Geotiff to COG, see cog_engine.cog_creation_options for the gdal creation options """
+    action = _source_action(fname, options)
+    if action == 'link':
+        with stage('link'):
+            changed = _link_file(fname, out_fname)
+    else:
+        # Written to a temporary file first, so a link to the source from an earlier run is replaced, not
+        # written through
+        changed = write_cog(fname, out_fname, options, copy_source=action == 'convert')
+    logging.info("%s: %s%s", basename(fname), {'link': "already a COG, linked",
+                                               'overviews': "tiled, overviews and COG layout only",
+                                               'convert': "converted"}[action],
+                 '' if changed else ", unchanged")
+
+
+def _convert_file(f_name, output_dir, options):
+    """ Convert a single Geotiff to COG, run by the worker pool """
+    filename = getfilename(f_name, output_dir)
+    _write_cogtiff(f_name, filename, options)
+    logging.info("Writing COG to %s", dirname(filename))
+    return check_outputs([filename])
+
+
+def _list_files(gtiff_path, include, exclude, index_fname, sizes=False):
+    index = ScanIndex(index_fname) if index_fname else None
+    for f_name, size in scan(gtiff_path, include, exclude, index, sizes):
+        yield (f_name, size) if sizes else f_name
+
+
+def _list_tasks(f_names, output_dir, options, manifest):
+    for f_name in f_names:
+        if manifest is not None:
+            if manifest.is_done(f_name, options):
+                logging.info("Skipping Conversion, %s already converted", basename(f_name))
+                continue
+            manifest.start(f_name, options)
+        logging.info("Reading %s", basename(f_name))
+        yield f_name, (f_name, output_dir, options)
 
 
 @click.command(help="\b Convert Geotiff to Cloud Optimized Geotiff using gdal."
@@ -116,22 +122,127 @@ def _write_cogtiff(fname, out_fname, outdir):
               type=click.Path(exists=True, readable=True))
 @click.option('--output', '-o', required=True, help="Write COG's into this folder",
               type=click.Path(exists=True, writable=True))
-def main(path, output):
+@click.option('--workers', '-w', default=1, show_default=True, help="Number of files to convert in parallel",
+              type=click.IntRange(min=1))
+@click.option('--engine', '-e', default=default_engine(), show_default=True,
+              help="Convert in-process with the GDAL python bindings or with the gdal command line tools",
+              type=click.Choice(ENGINES))
+@click.option('--profile', default=DEFAULT_PROFILE, show_default=True,
+              help="Compression profile of the COGs", type=click.Choice(sorted(PROFILES)))
+@click.option('--resampling', default='average', show_default=True, help="Resampling of the overviews",
+              type=click.Choice(RESAMPLING))
+@click.option('--overviews', default='numpy', show_default=True,
+              help="Build the overviews with NumPy, nodata aware and level by level, or with gdal",
+              type=click.Choice(BUILDERS))
+@click.option('--threads', '-t', default=1, show_default=True, type=click.IntRange(min=0),
+              help="Threads compressing the tiles and building the overviews of one file, 0 for all the cpus")
+@click.option('--memory-limit', default=None, type=click.IntRange(min=64),
+              help="Stream large rasters through a tiled intermediate next to the output, keeping the memory"
+                   " of each worker under this many MB")
+@click.option('--include', multiple=True, default=['*.tif'], show_default=True,
+              help="Glob of the file names or relative paths to convert, can be repeated")
+@click.option('--exclude', multiple=True, help="Glob of the file names, folders or relative paths to skip,"
+                                                " can be repeated")
+@click.option('--index/--no-index', default=True, show_default=True,
+              help="Keep an index of the input folders in the output folder and only list the changed ones")
+@click.option('--fast-path/--no-fast-path', default=True, show_default=True,
+              help="Link the Geotiffs that already are valid COGs and only add overviews to the tiled ones,"
+                   " instead of converting them all")
+@click.option('--memmap/--no-memmap', default=True, show_default=True,
+              help="Read uncompressed, stripped Geotiffs in place through a memory map instead of copying them,"
+                   " with the gdal engine")
+@click.option('--manifest/--no-manifest', default=True, show_default=True,
+              help="Record conversions in the output folder and skip the files already converted")
+@click.option('--queue', '-q', default=None, type=click.Path(file_okay=False, writable=True),
+              help="Take the files from this shared work queue instead of walking the input folder,"
+                   " see cog_queue")
+@click.option('--plan', is_flag=True, default=False,
+              help="Only write the files of the input folder as tasks of --queue, largest first")
+@click.option('--lease', default=DEFAULT_LEASE, show_default=True, type=click.IntRange(min=10),
+              help="Seconds after which a task of a worker that stopped sending heartbeats is reclaimed")
+@click.option('--upload', '-u', default=None,
+              help="Upload each COG and yaml once written and validated, to s3://bucket/prefix or a local folder")
+@click.option('--upload-workers', default=4, show_default=True, help="Number of concurrent uploads",
+              type=click.IntRange(min=1))
+@click.option('--schedule', is_flag=True, default=False,
+              help="Convert the largest files first and share slots for the read, encode and write stages between"
+                   " the workers, tuned from the throughput, see cog_scheduler")
+@click.option('--encode-slots', default=None, type=click.IntRange(min=1),
+              help="With --schedule, number of workers encoding at a time  [default: number of cpus]")
+@click.option('--metrics', default=None, help="Append the per file and per stage metrics to this JSON lines file",
+              type=click.Path(dir_okay=False, writable=True))
+@click.option('--prometheus', default=None, help="Write the metrics summary of the run to this Prometheus textfile",
+              type=click.Path(dir_okay=False, writable=True))
+def main(path, output, workers, engine, profile, resampling, overviews, memory_limit, threads, include, exclude,
+         index, manifest, upload, upload_workers, queue, plan, lease, metrics, prometheus,
+         fast_path, memmap, schedule, encode_slots):
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
     gtiff_path = os.path.abspath(path)
     output_dir = os.path.abspath(output)
-    count = 0
-    for path, subdirs, files in os.walk(gtiff_path):
-        for fname in files:
-            print(fname)
-            if fname.endswith('.tif'):
-                f_name = os.path.join(path, fname)
-                logging.info("Reading %s", basename(f_name))
-                filename = getfilename(f_name, output_dir)
-                _write_cogtiff(f_name, filename, output_dir)
-                count = count+1
-                logging.info("Writing COG to %s, %i", dirname(filename), count)
-
-               
+    options = {'engine': engine, 'profile': profile, 'resampling': resampling, 'overviews': overviews,
+               'memory_limit': memory_limit, 'threads': threads, 'fast_path': fast_path,
+               'memmap': memmap}
+    index_fname = pjoin(output_dir, INDEX_NAME) if index else None
+    if plan:
+        if queue is None:
+            raise click.UsageError("--plan needs --queue")
+        sources = _list_files(gtiff_path, include, exclude, index_fname, sizes=True)
+        count = WorkQueue(queue, lease).plan(sources)
+        logging.info("Planned %i tasks in %s", count, queue)
+        return
+    work_queue = WorkQueue(queue, lease) if queue else None
+    if work_queue is not None:
+        # The queue records what is done, the manifest database is not safe to share between nodes
+        manifest = False
+        f_names = work_queue.sources()
+        work_queue.start_heartbeat()
+    elif schedule:
+        f_names = largest_first(_list_files(gtiff_path, include, exclude, index_fname, sizes=True))
+    else:
+        f_names = _list_files(gtiff_path, include, exclude, index_fname)
+    manifest = Manifest(output_dir) if manifest else None
+    uploader = Uploader(get_backend(upload), output_dir, upload_workers) if upload else None
+    metrics = MetricsLog(metrics)
+    scheduler = Scheduler(workers, encode_slots) if schedule else None
+
+    def on_done(fname, outputs):
+        if manifest is not None:
+            manifest.finish(fname, outputs)
+        if work_queue is not None:
+            work_queue.complete(fname)
+        if uploader is not None:
+            uploader.upload_valid(outputs)
+
+    def on_failed(fname, error):
+        if manifest is not None:
+            manifest.fail(fname, error)
+        if work_queue is not None:
+            work_queue.fail(fname, error)
+
+    summary = None
+    try:
+        while True:
+            summary = run_tasks(_convert_file, _list_tasks(f_names, output_dir, options, manifest), workers,
+                                on_done=on_done, on_failed=on_failed, metrics=metrics,
+                                scheduler=scheduler, summary=summary)
+            # The tasks of this node are finished, wait for those of the others in case they are reclaimed
+            if work_queue is None or not work_queue.wait():
+                break
+            f_names = work_queue.sources()
+    finally:
+        if work_queue is not None:
+            work_queue.stop_heartbeat()
+        # Wait for the queued uploads even if the run failed, so none is dropped without being reported
+        if uploader is not None:
+            uploader.close()
+        metrics.close()
+    summary.log()
+    metrics.report()
+    if prometheus:
+        metrics.write_prometheus(prometheus)
+    if summary.failed or (uploader is not None and uploader.failed):
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     main()
@@ -1,26 +1,29 @@
 from os.path import join as pjoin, basename, dirname, exists, splitext
-import tempfile
-from subprocess import check_call
-import subprocess
 import click
 import os
+import re
+import sys
+import json
+import uuid
 import logging
 from osgeo import gdal
-import xarray
+import netCDF4
 import yaml
 from yaml import CLoader as Loader, CDumper as Dumper
 import rasterio
 import numpy
-
-
-def run_command(command, work_dir): 
-    """ 
-    A simple utility to execute a subprocess command. 
-    """ 
-    try:
-        check_call(command, stderr=subprocess.STDOUT, cwd=work_dir)
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError("command '{}' return with error (code {}): {}".format(e.cmd, e.returncode, e.output))
+from cog_pool import run_tasks
+from cog_scheduler import Scheduler, largest_first
+from cog_engine import write_cog, copy_metadata, default_engine, ENGINES
+from cog_profiles import PROFILES, DEFAULT_PROFILE
+from cog_overviews import RESAMPLING, BUILDERS
+from cog_manifest import Manifest, check_outputs
+from cog_upload import Uploader, get_backend
+from cog_queue import WorkQueue, DEFAULT_LEASE
+from cog_scan import scan, ScanIndex, INDEX_NAME
+from cog_metrics import MetricsLog, stage
+from cog_catalogue import write_catalogues, CATALOGUES
+from cog_publish import publish_bytes
 
 
 def check_file_exists(fname):
@@ -61,8 +64,18 @@ def get_bandname(filename):
     return (filename.split(':'))[-1]
 
 
-def add_image_path(bands, fname, rc, count):
+def add_image_path(bands, fname, rc, count, stacked_bands=None):
+    """ Point the bands of the dataset at their COGs
+        stacked_bands: The measurement names in the band order of the stacked COG of the time slice,
+                       with --stack-bands
+    """
     for key, value in bands.items():
+        if stacked_bands is not None:
+            if key not in stacked_bands:
+                raise RuntimeError("Band {} of the dataset yaml is not a variable of {}".format(key, fname))
+            value['layer'] = str(stacked_bands.index(key) + 1)
+            value['path'] = basename(get_stacked_fname(fname, rc, count + 1))
+            continue
         value['layer'] = '1'
         if rc > 1:
             value['path'] = basename(fname) + '_' + str(count+1) + '_' + key + '.tif'
@@ -71,108 +84,304 @@ def add_image_path(bands, fname, rc, count):
     return bands
 
 
-def _write_dataset(fname, file_path, rastercount):
-    """ Write the dataset which is in indexable format to datacube and update the format name too GeoTIFF"""
-    dataset_array = xarray.open_dataset(fname)
-    for count in range(rastercount):
+# Lines of a yaml document that would break a multi-document stream
+YAML_MARKERS = re.compile(r'^(---|\.\.\.|%)', re.MULTILINE)
+
+
+def _read_dataset_docs(nc_dataset, rastercount):
+    """ The dataset yaml of every time slice, read in one go from the 'dataset' variable of the open netcdf """
+    variable = nc_dataset.variables['dataset']
+    variable.set_auto_maskandscale(False)
+    variable.set_auto_chartostring(False)
+    docs = variable[:]
+    if docs.dtype.kind == 'S' and docs.dtype.itemsize == 1 and docs.ndim > 0:
+        # Fixed length character array, join the characters of every slice
+        docs = netCDF4.chartostring(docs, encoding='bytes')
+    docs = [doc.decode('utf-8') if isinstance(doc, bytes) else doc for doc in numpy.atleast_1d(docs).ravel()]
+    if len(docs) < rastercount:
+        raise RuntimeError("{} has {} dataset documents for {} time slices".format(
+            nc_dataset.filepath(), len(docs), rastercount))
+    return docs[:rastercount]
+
+
+def _load_docs(docs):
+    """ Parse the yaml documents in one pass of the C loader, or one by one if they have markers of their own """
+    if not any(YAML_MARKERS.search(doc) for doc in docs):
+        datasets = list(yaml.load_all('\n---\n'.join(docs), Loader=Loader))
+        if len(datasets) == len(docs):
+            return datasets
+    return [yaml.load(doc, Loader=Loader) for doc in docs]
+
+
+def _json_default(value):
+    """ Dates and other values yaml parsed that json can not serialise """
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def _write_dataset(nc_dataset, file_path, rastercount, datasets_jsonl=False, stacked_bands=None):
+    """ Write the dataset which is in indexable format to datacube and update the format name too GeoTIFF
+        nc_dataset is the open netCDF4.Dataset. With datasets_jsonl all the datasets are also written
+        as one JSON line each to <file_path>.datasets.jsonl, for bulk indexing
+        stacked_bands: The measurement names in band order, when the bands are stacked in one COG
+    """
+    docs = _read_dataset_docs(nc_dataset, rastercount)
+    y_fnames = []
+    lines = []
+    for count, dataset in enumerate(_load_docs(docs)):
         if rastercount > 1:
             y_fname = file_path + '_' + str(count+1) + '.yaml'
-            dataset_object = (dataset_array.dataset.item(count)).decode('utf-8')
         else:
             y_fname = file_path + '.yaml'
-            dataset_object = (dataset_array.dataset.item()).decode('utf-8')
-        dataset = yaml.load(dataset_object, Loader=Loader)
         bands = dataset['image']['bands']
-        dataset['image']['bands'] = add_image_path(bands, file_path, rastercount, count)
+        dataset['image']['bands'] = add_image_path(bands, file_path, rastercount, count, stacked_bands)
         dataset['format'] = {'name': 'GeoTIFF'}
         dataset['lineage'] = {'source_datasets': {}}
-        with open(y_fname, 'w') as fp:
-            yaml.dump(dataset, fp, default_flow_style=False, Dumper=Dumper)
-            logging.info("Writing dataset Yaml to %s", basename(y_fname))
-
-
-def _write_cogtiff(out_f_name, subdatasets, rastercount):
-    """ Convert the Geotiff to COG using gdal commands
-        Blocksize is 512
-        TILED <boolean>: Switch to tiled format
-        COPY_SRC_OVERVIEWS <boolean>: Force copy of overviews of source dataset
-        COMPRESS=[NONE/DEFLATE]: Set the compression to use. DEFLATE is only available if NetCDF has been compiled with
-                  NetCDF-4 support. NC4C format is the default if DEFLATE compression is used.
-        ZLEVEL=[1-9]: Set the level of compression when using DEFLATE compression. A value of 9 is best,
-                      and 1 is least compression. The default is 1, which offers the best time/compression ratio.
-        BLOCKXSIZE <int>: Tile Width
-        BLOCKYSIZE <int>: Tile/Strip Height
-        PREDICTOR <int>: Predictor Type (1=default, 2=horizontal differencing, 3=floating point prediction)
-        PROFILE <string-select>: possible values: GDALGeoTIFF,GeoTIFF,BASELINE,
+        text = yaml.dump(dataset, default_flow_style=False, Dumper=Dumper)
+        publish_bytes(y_fname, text.encode('utf-8'))
+        y_fnames.append(y_fname)
+        if datasets_jsonl:
+            lines.append(json.dumps(dict(dataset, path=basename(y_fname)), default=_json_default))
+    logging.info("Wrote %i dataset yamls of %s", len(y_fnames), basename(file_path))
+    if datasets_jsonl:
+        jsonl_fname = file_path + '.datasets.jsonl'
+        publish_bytes(jsonl_fname, ('\n'.join(lines) + '\n').encode('utf-8'))
+        y_fnames.append(jsonl_fname)
+    return y_fnames
+
+
+def get_out_fname(out_f_name, band_name, rastercount, count):
+    if rastercount > 1:
+        return out_f_name + '_' + str(count) + '_' + band_name + '.tif'
+    return out_f_name + '_' + band_name + '.tif'
+
+
+def get_stacked_fname(out_f_name, rastercount, count):
+    """ The COG of time slice count with all the measurements as bands """
+    if rastercount > 1:
+        return out_f_name + '_' + str(count) + '.tif'
+    return out_f_name + '.tif'
+
+
+def _time_chunk(variable):
+    """ Number of time slices stored in one chunk of the netcdf variable """
+    chunking = variable.chunking()
+    if chunking == 'contiguous' or variable.ndim < 3:
+        return 1
+    return max(chunking[0], 1)
+
+
+def _row_chunk(variable):
+    chunking = variable.chunking()
+    if chunking == 'contiguous':
+        return variable.shape[-2]
+    return chunking[-2]
+
+
+def _read_slices(nc_dataset, sds, band_name):
+    """ Read the netcdf variable chunk by chunk, so that every chunk is only decompressed once,
+        and yield (count, gdal MEM dataset, band) for each time slice, in order
+        The MEM dataset holds all the time slices of one chunk, band is the slice's band number in it
     """
-    with tempfile.TemporaryDirectory() as tmpdir:
-        for netcdf in subdatasets[:-1]:
-            for count in range(1, rastercount + 1):
-                band_name = get_bandname(netcdf[0])
-                if rastercount > 1:
-                    out_fname = out_f_name + '_' + str(count) + '_' + band_name + '.tif'
+    variable = nc_dataset.variables[band_name]
+    variable.set_auto_maskandscale(False)
+    rastercount = sds.RasterCount
+    xsize, ysize = sds.RasterXSize, sds.RasterYSize
+    # GDAL presents netcdfs north up, flip the rows if the y coordinate is stored ascending
+    y = nc_dataset.variables[variable.dimensions[-2]]
+    flip = len(y) > 1 and y[0] < y[-1]
+
+    t_chunk = _time_chunk(variable)
+    y_chunk = _row_chunk(variable)
+    mem_driver = gdal.GetDriverByName('MEM')
+    for t_start in range(0, rastercount, t_chunk):
+        t_end = min(t_start + t_chunk, rastercount)
+        mem_ds = mem_driver.Create('', xsize, ysize, t_end - t_start, sds.GetRasterBand(1).DataType)
+        # The metadata gdal_translate NETCDF:...:variable -b N carries: NC_GLOBAL and variable attributes,
+        # NETCDF_DIM_time, units, scale and offset of each slice
+        copy_metadata(sds, mem_ds, list(range(t_start + 1, t_end + 1)))
+        with stage('read'):
+            for y_start in range(0, ysize, y_chunk):
+                y_end = min(y_start + y_chunk, ysize)
+                if variable.ndim < 3:
+                    slab = variable[y_start:y_end, :][numpy.newaxis]
                 else:
-                    out_fname = out_f_name + '_' + band_name + '.tif'
-
-                env = ['GDAL_DISABLE_READDIR_ON_OPEN=YES',
-                       'CPL_VSIL_CURL_ALLOWED_EXTENSIONS=.tif']
-                subprocess.check_call(env, shell=True)
-
-                # copy to a tempfolder
-                temp_fname = pjoin(tmpdir, basename(out_fname))
-                to_cogtif = [
-                    'gdal_translate',
-                    '-of',
-                    'GTIFF',
-                    '-b',
-                    str(count),
-                    netcdf[0],
-                    temp_fname]
-                run_command(to_cogtif, tmpdir)
-
-                # Add Overviews
-                # gdaladdo - Builds or rebuilds overview images.
-                # 2, 4, 8,16,32 are levels which is a list of integral overview levels to build.
-                add_ovr = [
-                    'gdaladdo',
-                    '-r',
-                    'average',
-                    '--config',
-                    'GDAL_TIFF_OVR_BLOCKSIZE',
-                    '512',
-                    temp_fname,
-                    '2',
-                    '4',
-                    '8',
-                    '16',
-                    '32']
-                run_command(add_ovr, tmpdir)
-
-                # Convert to COG
-                cogtif = [
-                    'gdal_translate',
-                    '-co',
-                    'TILED=YES',
-                    '-co',
-                    'COPY_SRC_OVERVIEWS=YES',
-                    '-co',
-                    'COMPRESS=DEFLATE',
-                    '-co',
-                    'ZLEVEL=9',
-                    '--config',
-                    'GDAL_TIFF_OVR_BLOCKSIZE',
-                    '512',
-                    '-co',
-                    'BLOCKXSIZE=512',
-                    '-co',
-                    'BLOCKYSIZE=512',
-                    '-co',
-                    'PREDICTOR=2',
-                    '-co',
-                    'PROFILE=GeoTIFF',
-                    temp_fname,
-                    out_fname]
-                run_command(cogtif, dirname(out_f_name))
+                    slab = variable[t_start:t_end, y_start:y_end, :]
+                if flip:
+                    slab = slab[:, ::-1, :]
+                y_off = ysize - y_end if flip else y_start
+                for index in range(t_end - t_start):
+                    mem_ds.GetRasterBand(index + 1).WriteArray(slab[index], 0, y_off)
+        for index in range(t_end - t_start):
+            yield t_start + index + 1, mem_ds, index + 1
+        mem_ds = None
+
+
+def _fits_in_memory(nc_dataset, sds, band_name, memory_limit):
+    """ True if the time slices of one chunk of the variable take less than half of memory_limit MB """
+    if not memory_limit:
+        return True
+    variable = nc_dataset.variables[band_name]
+    slab_bytes = _time_chunk(variable) * sds.RasterXSize * sds.RasterYSize * variable.dtype.itemsize
+    return slab_bytes <= memory_limit * 1024 * 1024 // 2
+
+
+def _write_cogtiff(out_f_name, subdatasets, rastercount, options, nc_dataset=None):
+    """ Convert every band of every netcdf subdataset to its own COG,
+        see cog_engine.cog_creation_options for the gdal creation options
+        With the in-process engine the netcdf is read once through nc_dataset (a netCDF4.Dataset),
+        unless one chunk of time slices does not fit under options['memory_limit'].
+        Otherwise every band is read on its own
+    """
+    out_fnames = []
+    for netcdf in subdatasets[:-1]:
+        band_name = get_bandname(netcdf[0])
+        sds = gdal.Open(netcdf[0], gdal.GA_ReadOnly)
+        if (options['engine'] == 'gdal' and nc_dataset is not None and
+                _fits_in_memory(nc_dataset, sds, band_name, options.get('memory_limit'))):
+            for count, mem_ds, band in _read_slices(nc_dataset, sds, band_name):
+                out_fname = get_out_fname(out_f_name, band_name, rastercount, count)
+                write_cog(mem_ds, out_fname, options, band=band)
+                out_fnames.append(out_fname)
+        else:
+            for count in range(1, rastercount + 1):
+                out_fname = get_out_fname(out_f_name, band_name, rastercount, count)
+                write_cog(netcdf[0], out_fname, options, band=count)
+                out_fnames.append(out_fname)
+        sds = None
+    return out_fnames
+
+
+def _check_stackable(subdatasets):
+    """ The measurements go in one GTiff, they need the same data type and nodata value """
+    layouts = set()
+    for netcdf in subdatasets:
+        sds = gdal.Open(netcdf[0], gdal.GA_ReadOnly)
+        band = sds.GetRasterBand(1)
+        layouts.add((band.DataType, band.GetNoDataValue(), sds.RasterXSize, sds.RasterYSize))
+        sds = None
+    if len(layouts) > 1:
+        raise RuntimeError("The measurements of {} differ in data type, nodata or size, they can not be"
+                           " stacked".format(subdatasets[0][0]))
+
+
+def _write_stacked_cogtiff(out_f_name, subdatasets, rastercount, options):
+    """ Convert every time slice to one COG with the measurements (the netcdf subdatasets) as bands,
+        through a VRT of the band of the slice in every subdataset
+    """
+    names = [netcdf[0] for netcdf in subdatasets[:-1]]
+    _check_stackable(subdatasets[:-1])
+    out_fnames = []
+    for count in range(1, rastercount + 1):
+        out_fname = get_stacked_fname(out_f_name, rastercount, count)
+        if options['engine'] == 'gdal':
+            vrt_fname = '/vsimem/{}_{}.vrt'.format(uuid.uuid4().hex, basename(out_fname))
+        else:
+            vrt_fname = pjoin(dirname(out_fname), '.{}.vrt'.format(basename(out_fname)))
+        # The band of the slice is selected in a VRT of every subdataset, how BuildVRT combines -b with
+        # -separate differs between GDAL versions before 3.8
+        slice_fnames = ['{}_{}.vrt'.format(vrt_fname[:-len('.vrt')], index) for index in range(len(names))]
+        vrt_ds = None
+        try:
+            for name, slice_fname in zip(names, slice_fnames):
+                if gdal.Translate(slice_fname, name, format='VRT', bandList=[count]) is None:
+                    raise RuntimeError("Unable to read slice {} of {}: {}".format(count, name,
+                                                                                  gdal.GetLastErrorMsg()))
+            vrt_ds = gdal.BuildVRT(vrt_fname, slice_fnames, separate=True)
+            if vrt_ds is None:
+                raise RuntimeError("Unable to stack the measurements of {}: {}".format(out_fname,
+                                                                                      gdal.GetLastErrorMsg()))
+            for index, name in enumerate(names):
+                vrt_ds.GetRasterBand(index + 1).SetDescription(get_bandname(name))
+            if options['engine'] == 'gdal':
+                write_cog(vrt_ds, out_fname, options)
+            else:
+                # The command line tools read the VRT from disk
+                vrt_ds = None
+                write_cog(vrt_fname, out_fname, options)
+        finally:
+            vrt_ds = None
+            for fname in [vrt_fname] + slice_fnames:
+                gdal.Unlink(fname)
+        out_fnames.append(out_fname)
+    return out_fnames
+
+
+def _slice_times(nc_dataset, rastercount):
+    """ The ISO 8601 datetime of every time slice, None if the netcdf has no time coordinate """
+    if 'time' not in nc_dataset.variables:
+        return [None] * rastercount
+    variable = nc_dataset.variables['time']
+    dates = netCDF4.num2date(variable[:], variable.units, getattr(variable, 'calendar', 'standard'))
+    times = [date.isoformat() + 'Z' for date in numpy.atleast_1d(dates)]
+    return (times + [None] * rastercount)[:rastercount]
+
+
+def _catalogue_slices(gtiff_fname, subdatasets, rastercount, times, stacked_bands=None):
+    """ The COG and layer of every measurement of every time slice, see cog_catalogue.write_catalogues """
+    band_names = [get_bandname(netcdf[0]) for netcdf in subdatasets[:-1]]
+    slices = []
+    for count in range(1, rastercount + 1):
+        if stacked_bands is not None:
+            fname = get_stacked_fname(gtiff_fname, rastercount, count)
+            assets = {band_name: (fname, index + 1) for index, band_name in enumerate(stacked_bands)}
+        else:
+            assets = {band_name: (get_out_fname(gtiff_fname, band_name, rastercount, count), 1)
+                      for band_name in band_names}
+        item_id = basename(gtiff_fname) + ('_' + str(count) if rastercount > 1 else '')
+        slices.append({'id': item_id, 'datetime': times[count - 1], 'assets': assets})
+    return slices
+
+
+def _convert_file(f_name, gtiff_fname, options):
+    """ Convert all the subdatasets and bands of a netcdf to COG and write the dataset yaml,
+        run by the worker pool
+    """
+    dataset = gdal.Open(f_name, gdal.GA_ReadOnly)
+    subdatasets = dataset.GetSubDatasets()
+    # ---To Check if NETCDF is stacked or unstacked --
+    sds_open = gdal.Open(subdatasets[0][0])
+    rastercount = sds_open.RasterCount
+    dataset = None
+    stacked_bands = None
+    with netCDF4.Dataset(f_name) as nc_dataset:
+        if options.get('stack_bands'):
+            out_fnames = _write_stacked_cogtiff(gtiff_fname, subdatasets, rastercount, options)
+            stacked_bands = [get_bandname(netcdf[0]) for netcdf in subdatasets[:-1]]
+        else:
+            out_fnames = _write_cogtiff(gtiff_fname, subdatasets, rastercount, options, nc_dataset)
+        with stage('yaml'):
+            out_fnames += _write_dataset(nc_dataset, gtiff_fname, rastercount, options.get('datasets_jsonl'),
+                                         stacked_bands)
+        if options.get('catalogue'):
+            with stage('catalogue'):
+                slices = _catalogue_slices(gtiff_fname, subdatasets, rastercount,
+                                           _slice_times(nc_dataset, rastercount), stacked_bands)
+                out_fnames += write_catalogues(gtiff_fname, slices, options['catalogue'])
+    logging.info("Writing COG to %s", basename(gtiff_fname))
+    return check_outputs(out_fnames)
+
+
+def _list_files(netcdf_path, include, exclude, index_fname, sizes=False):
+    index = ScanIndex(index_fname) if index_fname else None
+    for f_name, size in scan(netcdf_path, include, exclude, index, sizes):
+        yield (f_name, size) if sizes else f_name
+
+
+def _list_tasks(f_names, output_dir, options, manifest, skip_existing=True):
+    for f_name in f_names:
+        logging.info("Reading %s", basename(f_name))
+        gtiff_fname = getfilename(f_name, output_dir)
+
+        if manifest is None and skip_existing and check_file_exists(gtiff_fname):
+            logging.info("Skipping Conversion, %s already exists", basename(gtiff_fname))
+        elif manifest is not None and manifest.is_done(f_name, options):
+            logging.info("Skipping Conversion, %s already converted", basename(gtiff_fname))
+        else:
+            if manifest is not None:
+                manifest.start(f_name, options)
+            yield f_name, (f_name, gtiff_fname, options)
 
 
 @click.command(help="\b Convert netcdf to Geotiff and then to Cloud Optimized Geotiff using gdal."
@@ -183,7 +392,64 @@ def _write_cogtiff(out_f_name, subdatasets, rastercount):
               type=click.Path(exists=True, writable=True))
 @click.option('--subfolder', '-s', required=False, default=None, help="Subfolder for this task",
               type=str)
-def main(path, output, subfolder):
+@click.option('--workers', '-w', default=1, show_default=True, help="Number of netcdfs to convert in parallel",
+              type=click.IntRange(min=1))
+@click.option('--engine', '-e', default=default_engine(), show_default=True,
+              help="Convert in-process with the GDAL python bindings or with the gdal command line tools",
+              type=click.Choice(ENGINES))
+@click.option('--profile', default=DEFAULT_PROFILE, show_default=True,
+              help="Compression profile of the COGs", type=click.Choice(sorted(PROFILES)))
+@click.option('--resampling', default='average', show_default=True, help="Resampling of the overviews",
+              type=click.Choice(RESAMPLING))
+@click.option('--overviews', default='numpy', show_default=True,
+              help="Build the overviews with NumPy, nodata aware and level by level, or with gdal",
+              type=click.Choice(BUILDERS))
+@click.option('--threads', '-t', default=1, show_default=True, type=click.IntRange(min=0),
+              help="Threads compressing the tiles and building the overviews of one file, 0 for all the cpus")
+@click.option('--memory-limit', default=None, type=click.IntRange(min=64),
+              help="Stream large rasters through a tiled intermediate next to the output, keeping the memory"
+                   " of each worker under this many MB")
+@click.option('--include', multiple=True, default=['*.nc'], show_default=True,
+              help="Glob of the file names or relative paths to convert, can be repeated")
+@click.option('--exclude', multiple=True, help="Glob of the file names, folders or relative paths to skip,"
+                                                " can be repeated")
+@click.option('--index/--no-index', default=True, show_default=True,
+              help="Keep an index of the input folders in the output folder and only list the changed ones")
+@click.option('--stack-bands', is_flag=True, default=False,
+              help="Write all the measurements of a time slice as the bands of one COG, <name>_<n>.tif")
+@click.option('--interleave', default='pixel', show_default=True, type=click.Choice(['pixel', 'band']),
+              help="Layout of the bands of a stacked COG: all the bands of a tile together, or band after band")
+@click.option('--catalogue', multiple=True, type=click.Choice(CATALOGUES),
+              help="Also write a VRT per measurement stacking the time slices, and/or a STAC item collection"
+                   " of the COGs of every netcdf, can be repeated")
+@click.option('--datasets-jsonl', is_flag=True, default=False,
+              help="Also write the datasets of every netcdf as JSON lines to <name>.datasets.jsonl, for bulk indexing")
+@click.option('--manifest/--no-manifest', default=True, show_default=True,
+              help="Record conversions in the output folder and skip the netcdfs already converted,"
+                   " without it a netcdf is skipped if its yaml exists")
+@click.option('--queue', '-q', default=None, type=click.Path(file_okay=False, writable=True),
+              help="Take the files from this shared work queue instead of walking the input folder,"
+                   " see cog_queue")
+@click.option('--plan', is_flag=True, default=False,
+              help="Only write the files of the input folder as tasks of --queue, largest first")
+@click.option('--lease', default=DEFAULT_LEASE, show_default=True, type=click.IntRange(min=10),
+              help="Seconds after which a task of a worker that stopped sending heartbeats is reclaimed")
+@click.option('--upload', '-u', default=None,
+              help="Upload each COG and yaml once written and validated, to s3://bucket/prefix or a local folder")
+@click.option('--upload-workers', default=4, show_default=True, help="Number of concurrent uploads",
+              type=click.IntRange(min=1))
+@click.option('--schedule', is_flag=True, default=False,
+              help="Convert the largest files first and share slots for the read, encode and write stages between"
+                   " the workers, tuned from the throughput, see cog_scheduler")
+@click.option('--encode-slots', default=None, type=click.IntRange(min=1),
+              help="With --schedule, number of workers encoding at a time  [default: number of cpus]")
+@click.option('--metrics', default=None, help="Append the per file and per stage metrics to this JSON lines file",
+              type=click.Path(dir_okay=False, writable=True))
+@click.option('--prometheus', default=None, help="Write the metrics summary of the run to this Prometheus textfile",
+              type=click.Path(dir_okay=False, writable=True))
+def main(path, output, subfolder, workers, engine, profile, resampling, overviews, memory_limit, threads, include,
+         exclude, index, manifest, upload, upload_workers, queue, plan, lease, metrics, prometheus,
+         datasets_jsonl, stack_bands, interleave, catalogue, schedule, encode_slots):
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
     if subfolder is None:
         netcdf_path = os.path.abspath(path)
@@ -191,26 +457,77 @@ def main(path, output, subfolder):
         netcdf_path = os.path.abspath(pjoin(path, subfolder))
     output_dir = os.path.abspath(output)
 
-    for path, subdirs, files in os.walk(netcdf_path):
-        for fname in files:
-            if fname.endswith('.nc'):
-                f_name = pjoin(path, fname)
-                logging.info("Reading %s", basename(f_name))
-                gtiff_fname = getfilename(f_name, output_dir)
+    options = {'engine': engine, 'profile': profile, 'resampling': resampling, 'overviews': overviews,
+               'memory_limit': memory_limit, 'threads': threads}
+    # Only set when asked for, so the manifest does not take them for a change of options otherwise
+    if datasets_jsonl:
+        options['datasets_jsonl'] = True
+    if stack_bands:
+        options['stack_bands'] = True
+        options['interleave'] = interleave
+    if catalogue:
+        options['catalogue'] = sorted(set(catalogue))
+    index_fname = pjoin(output_dir, INDEX_NAME) if index else None
+    if plan:
+        if queue is None:
+            raise click.UsageError("--plan needs --queue")
+        sources = _list_files(netcdf_path, include, exclude, index_fname, sizes=True)
+        count = WorkQueue(queue, lease).plan(sources)
+        logging.info("Planned %i tasks in %s", count, queue)
+        return
+    work_queue = WorkQueue(queue, lease) if queue else None
+    if work_queue is not None:
+        # The queue records what is done, the manifest database is not safe to share between nodes
+        manifest = False
+        f_names = work_queue.sources()
+        work_queue.start_heartbeat()
+    elif schedule:
+        f_names = largest_first(_list_files(netcdf_path, include, exclude, index_fname, sizes=True))
+    else:
+        f_names = _list_files(netcdf_path, include, exclude, index_fname)
+    manifest = Manifest(output_dir) if manifest else None
+    uploader = Uploader(get_backend(upload), output_dir, upload_workers) if upload else None
+    metrics = MetricsLog(metrics)
+    scheduler = Scheduler(workers, encode_slots) if schedule else None
+
+    def on_done(fname, outputs):
+        if manifest is not None:
+            manifest.finish(fname, outputs)
+        if work_queue is not None:
+            work_queue.complete(fname)
+        if uploader is not None:
+            uploader.upload_valid(outputs)
+
+    def on_failed(fname, error):
+        if manifest is not None:
+            manifest.fail(fname, error)
+        if work_queue is not None:
+            work_queue.fail(fname, error)
+
+    summary = None
+    try:
+        while True:
+            tasks = _list_tasks(f_names, output_dir, options, manifest, skip_existing=work_queue is None)
+            summary = run_tasks(_convert_file, tasks, workers, on_done=on_done, on_failed=on_failed,
+                                metrics=metrics, scheduler=scheduler, summary=summary)
+            # The tasks of this node are finished, wait for those of the others in case they are reclaimed
+            if work_queue is None or not work_queue.wait():
+                break
+            f_names = work_queue.sources()
+    finally:
+        if work_queue is not None:
+            work_queue.stop_heartbeat()
+        # Wait for the queued uploads even if the run failed, so none is dropped without being reported
+        if uploader is not None:
+            uploader.close()
+        metrics.close()
+    summary.log()
+    metrics.report()
+    if prometheus:
+        metrics.write_prometheus(prometheus)
+    if summary.failed or (uploader is not None and uploader.failed):
+        sys.exit(1)
+
 
-                if check_file_exists(gtiff_fname):
-                    logging.info("Skipping Conversion, %s already exists", basename(gtiff_fname))
-                else:
-                    dataset = gdal.Open(f_name, gdal.GA_ReadOnly)
-                    subdatasets = dataset.GetSubDatasets()
-                    # ---To Check if NETCDF is stacked or unstacked --
-                    sds_open = gdal.Open(subdatasets[0][0])
-                    rastercount = sds_open.RasterCount
-                    dataset = None
-                    _write_cogtiff(gtiff_fname, subdatasets, rastercount)
-                    _write_dataset(f_name, gtiff_fname, rastercount)
-                    logging.info("Writing COG to %s", basename(gtiff_fname))
-
-               
 if __name__ == "__main__":
     main()
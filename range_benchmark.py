@@ -0,0 +1,260 @@
+""" Measure what reading the produced COGs costs a client over HTTP range requests
+
+    The output folder is served by a local HTTP/1.1 server answering Range requests, and every
+    COG is read the way a tile client does, over one keep-alive connection:
+    header: the header and all the IFDs, read in 16KB blocks like gdal's /vsicurl/
+    overview: every tile of one overview level, --zoom 0 being the smallest overview
+    tiles: --tiles random 512x512 windows of the full resolution, block by block (tiles, or strips
+           for a file that is not tiled), the blocks contiguous in the file in one request
+    For each step the number of requests, the bytes transferred and the time are reported, per file
+    and per sub-folder of the output folder, e.g. one folder per creation profile.
+"""
+from os.path import join as pjoin, relpath, dirname
+from functools import partial
+from urllib.parse import quote
+from http.server import SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import http.server
+import http.client
+import click
+import os
+import re
+import sys
+import json
+import time
+import random
+import logging
+import threading
+from tiff_ifd import TIFF, RangeReader, TIFFError
+
+STEPS = ('header', 'overview', 'tiles')
+RANGE = re.compile(r'bytes=(\d+)-(\d*)$')
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """ Serve the files of a folder, answering a single Range of a GET with 206 Partial Content """
+    protocol_version = 'HTTP/1.1'
+    # The headers and the data are separate writes, without this delayed ACKs add 40ms to every request
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        match = RANGE.match(self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+            if start >= size or end < start:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            start, end = 0, size - 1
+            self.send_response(200)
+        self.send_header('Content-Type', 'image/tiff')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        with open(path, 'rb') as fp:
+            fp.seek(start)
+            self.wfile.write(fp.read(end - start + 1))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RangeServer(ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(root, host='127.0.0.1', port=0):
+    """ Start serving root in a background thread, return the server, its address is server.server_address """
+    server = RangeServer((host, port), partial(RangeRequestHandler, directory=root))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class RangeClient(object):
+    """ Range GETs of one file over a keep-alive connection, counting the requests, bytes and time """
+
+    def __init__(self, host, port, path):
+        self.conn = http.client.HTTPConnection(host, port)
+        self.path = path
+        self.requests = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def fetch(self, offset, length):
+        start = time.perf_counter()
+        self.conn.request('GET', self.path, headers={'Range': 'bytes={}-{}'.format(offset, offset + length - 1)})
+        response = self.conn.getresponse()
+        data = response.read()
+        if response.status not in (200, 206):
+            raise TIFFError('HTTP {} reading {}'.format(response.status, self.path))
+        self.seconds += time.perf_counter() - start
+        self.requests += 1
+        self.bytes += len(data)
+        return data
+
+    def counters(self):
+        return self.requests, self.bytes, self.seconds
+
+    def close(self):
+        self.conn.close()
+
+
+def _read_blocks(client, ifd, indices):
+    """ Read the blocks of ifd at indices, one request for every run of blocks that are contiguous in the
+        file, as gdal merges the ranges of adjacent blocks
+    """
+    ranges = []
+    for index in indices:
+        offset, = ifd.block_offsets(index, 1)
+        byte_count, = ifd.block_byte_counts(index, 1)
+        if not byte_count:
+            continue
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1][1] += byte_count
+        else:
+            ranges.append([offset, byte_count])
+    for offset, length in ranges:
+        client.fetch(offset, length)
+
+
+def _window_blocks(ifd, x, y, size=512):
+    """ The indices of the blocks of ifd covering the window of size pixels at x, y """
+    block_x, block_y = ifd.block_size
+    across = -(-ifd.width // block_x)
+    rows = range(y // block_y, min(-(-(y + size) // block_y), -(-ifd.height // block_y)))
+    cols = range(x // block_x, min(-(-(x + size) // block_x), across))
+    return [row * across + col for row in rows for col in cols]
+
+
+def benchmark_file(host, port, url_path, tiles=20, zoom=0, seed=0):
+    """ Read one served COG like a tile client, return the requests, bytes and milliseconds of every step """
+    rng = random.Random(seed)
+    client = RangeClient(host, port, url_path)
+    result = {'path': url_path}
+    try:
+        previous = client.counters()
+
+        def record(step):
+            now = client.counters()
+            result[step] = {'requests': now[0] - previous[0], 'bytes': now[1] - previous[1],
+                            'ms': (now[2] - previous[2]) * 1000}
+            return now
+
+        tiff = TIFF(RangeReader(client.fetch, url_path))
+        previous = record('header')
+
+        overviews = tiff.overviews
+        if overviews:
+            ifd = overviews[max(0, len(overviews) - 1 - zoom)]
+            across = -(-ifd.width // ifd.block_size[0])
+            down = -(-ifd.height // ifd.block_size[1])
+            _read_blocks(client, ifd, range(across * down))
+        previous = record('overview')
+
+        main = tiff.main
+        for _ in range(tiles):
+            x = rng.randrange(0, max(main.width // 512, 1)) * 512
+            y = rng.randrange(0, max(main.height // 512, 1)) * 512
+            _read_blocks(client, main, _window_blocks(main, x, y))
+        record('tiles')
+        result['tile_reads'] = tiles
+        result['tiled'] = main.is_tiled
+        result['overviews'] = len(overviews)
+    finally:
+        client.close()
+    return result
+
+
+def _summarise(results):
+    """ Sum the steps of the results of each group """
+    groups = {}
+    for result in results:
+        group = groups.setdefault(result['group'], {'files': 0, 'tile_reads': 0})
+        group['files'] += 1
+        group['tile_reads'] += result['tile_reads']
+        for step in STEPS:
+            totals = group.setdefault(step, {'requests': 0, 'bytes': 0, 'ms': 0.0})
+            for key in totals:
+                totals[key] += result[step][key]
+    return groups
+
+
+def _print_report(results, groups, per_file):
+    header = '%-40s %6s %8s %10s %8s %10s %10s %10s %10s' % (
+        'file' if per_file else 'folder', 'files', 'hdr req', 'hdr KB', 'ovr req', 'ovr KB', 'req/tile',
+        'KB/tile', 'ms/tile')
+
+    def row(name, files, entry, tiles):
+        return '%-40s %6i %8.1f %10.1f %8.1f %10.1f %10.2f %10.1f %10.2f' % (
+            name[-40:], files, entry['header']['requests'] / float(files), entry['header']['bytes'] / 1024.0 / files,
+            entry['overview']['requests'] / float(files), entry['overview']['bytes'] / 1024.0 / files,
+            entry['tiles']['requests'] / float(tiles or 1), entry['tiles']['bytes'] / 1024.0 / (tiles or 1),
+            entry['tiles']['ms'] / (tiles or 1))
+
+    print(header)
+    if per_file:
+        for result in results:
+            print(row(result['path'], 1, result, result['tile_reads']))
+        print('')
+    for name, group in sorted(groups.items()):
+        print(row(name, group['files'], group, group['tile_reads']))
+
+
+@click.command(help="\b Serve a folder of COGs over HTTP with Range support and measure the requests, bytes and"
+                    " latency of a header read, an overview read and random tile reads of every file.")
+@click.option('--path', '-p', required=True, help="Folder of the COGs to serve, e.g. the output of a conversion",
+              type=click.Path(exists=True, file_okay=False, readable=True))
+@click.option('--tiles', default=20, show_default=True, help="Random 512x512 windows read from each file",
+              type=click.IntRange(min=0))
+@click.option('--zoom', default=0, show_default=True, help="Overview level read in full, 0 is the smallest",
+              type=click.IntRange(min=0))
+@click.option('--seed', default=0, show_default=True, help="Seed of the random tile positions")
+@click.option('--per-file', is_flag=True, default=False, help="Report every file, not only every folder")
+@click.option('--json', 'json_fname', default=None, help="Also write the results to this JSON file",
+              type=click.Path(dir_okay=False, writable=True))
+def main(path, tiles, zoom, seed, per_file, json_fname):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    root = os.path.abspath(path)
+    fnames = sorted(pjoin(folder, fname) for folder, _, files in os.walk(root)
+                    for fname in files if fname.endswith('.tif'))
+    if not fnames:
+        logging.error("No COGs found in %s", path)
+        sys.exit(1)
+    server = serve(root)
+    host, port = server.server_address[:2]
+    logging.info("Serving %s on http://%s:%i/", root, host, port)
+    results = []
+    try:
+        for fname in fnames:
+            url_path = '/' + quote(relpath(fname, root))
+            try:
+                result = benchmark_file(host, port, url_path, tiles, zoom, seed)
+            except TIFFError as e:
+                logging.error("Unable to read %s: %s", url_path, e)
+                continue
+            result['group'] = dirname(relpath(fname, root)) or '.'
+            results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+    groups = _summarise(results)
+    _print_report(results, groups, per_file)
+    if json_fname:
+        with open(json_fname, 'w') as fp:
+            json.dump({'files': results, 'folders': groups}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
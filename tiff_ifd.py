@@ -0,0 +1,400 @@
+"""Read the IFD chain of a (Geo)TIFF without GDAL.
+
+Only the TIFF header, the IFDs and the tag values that are asked for are read,
+either through mmap for local files or through a fetch(offset, length) callable
+for byte ranges, e.g. HTTP range requests against object storage.
+validate() returns the same (errors, details) as
+validate_cloud_optimized_geotiff.validate().
+"""
+import os
+import mmap
+import struct
+
+# TIFF tags
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIG = 284
+PREDICTOR = 317
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SAMPLE_FORMAT = 339
+GDAL_NODATA = 42113
+
+# Integer field types, see FIELD_TYPES
+INTEGER_TYPES = (1, 3, 4, 6, 8, 9, 16, 17)
+
+# NewSubfileType bits
+REDUCED_RESOLUTION = 1
+MASK = 4
+
+# TIFF field type: (struct format, size)
+FIELD_TYPES = {
+    1: ('B', 1),   # BYTE
+    2: ('s', 1),   # ASCII
+    3: ('H', 2),   # SHORT
+    4: ('I', 4),   # LONG
+    5: ('II', 8),  # RATIONAL
+    6: ('b', 1),   # SBYTE
+    7: ('B', 1),   # UNDEFINED
+    8: ('h', 2),   # SSHORT
+    9: ('i', 4),   # SLONG
+    10: ('ii', 8),  # SRATIONAL
+    11: ('f', 4),  # FLOAT
+    12: ('d', 8),  # DOUBLE
+    13: ('I', 4),  # IFD
+    16: ('Q', 8),  # LONG8
+    17: ('q', 8),  # SLONG8
+    18: ('Q', 8),  # IFD8
+}
+
+
+class TIFFError(Exception):
+    pass
+
+
+class FileReader(object):
+    """ Read byte ranges of a local file through mmap """
+
+    def __init__(self, fname):
+        self.name = fname
+        self._fp = open(fname, 'rb')
+        size = os.fstat(self._fp.fileno()).st_size
+        if size == 0:
+            raise TIFFError('Empty file : %s' % fname)
+        self._mmap = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, offset, length):
+        return self._mmap[offset:offset + length]
+
+    def close(self):
+        self._mmap.close()
+        self._fp.close()
+
+
+class RangeReader(object):
+    """ Read byte ranges through fetch(offset, length), in aligned blocks that are cached
+        The first block covers the header and, for a COG, usually all of the IFDs
+    """
+
+    def __init__(self, fetch, name='', block_size=16384):
+        self.name = name
+        self.fetch = fetch
+        self.block_size = block_size
+        self._blocks = {}
+
+    def read(self, offset, length):
+        first = offset // self.block_size
+        last = (offset + length - 1) // self.block_size
+        missing = [index for index in range(first, last + 1) if index not in self._blocks]
+        if missing:
+            start = missing[0] * self.block_size
+            data = self.fetch(start, (missing[-1] + 1) * self.block_size - start)
+            for index in missing:
+                self._blocks[index] = data[(index - missing[0]) * self.block_size:
+                                           (index - missing[0] + 1) * self.block_size]
+        data = b''.join(self._blocks[index] for index in range(first, last + 1))
+        start = offset - first * self.block_size
+        return data[start:start + length]
+
+    def close(self):
+        self._blocks = {}
+
+
+class IFD(object):
+    """ One Image File Directory, the tag values are read when they are asked for """
+
+    def __init__(self, tiff, offset, entries):
+        self.tiff = tiff
+        self.offset = offset
+        self.entries = entries
+
+    def has(self, tag):
+        return tag in self.entries
+
+    def values(self, tag, start=0, count=None):
+        """ Return the values of tag as a tuple, from the value at index start and count of them """
+        field_type, field_count, inline, value_offset = self.entries[tag]
+        fmt, size = FIELD_TYPES[field_type]
+        count = field_count - start if count is None else min(count, field_count - start)
+        if count <= 0:
+            return ()
+        if inline is not None:
+            data = inline[start * size:(start + count) * size]
+        else:
+            data = self.tiff.reader.read(value_offset + start * size, count * size)
+        if len(data) < count * size:
+            raise TIFFError('Truncated value of tag %d' % tag)
+        if field_type == 2:
+            return (data.rstrip(b'\0').decode('ascii', 'replace'),)
+        return struct.unpack(self.tiff.byte_order + fmt * count, data)
+
+    def value(self, tag, default=None):
+        if tag not in self.entries:
+            return default
+        return self.values(tag, 0, 1)[0]
+
+    @property
+    def width(self):
+        return self.value(IMAGE_WIDTH)
+
+    @property
+    def height(self):
+        return self.value(IMAGE_LENGTH)
+
+    @property
+    def subfile_type(self):
+        return self.value(NEW_SUBFILE_TYPE, 0)
+
+    @property
+    def is_tiled(self):
+        return self.has(TILE_OFFSETS)
+
+    @property
+    def block_size(self):
+        """ (width, height) of a tile, or of a strip for stripped files, like gdal's GetBlockSize """
+        if self.is_tiled:
+            return self.value(TILE_WIDTH), self.value(TILE_LENGTH)
+        return self.width, min(self.value(ROWS_PER_STRIP, self.height), self.height)
+
+    @property
+    def compression(self):
+        return self.value(COMPRESSION, 1)
+
+    def block_offsets(self, start=0, count=None):
+        return self.values(TILE_OFFSETS if self.is_tiled else STRIP_OFFSETS, start, count)
+
+    def block_byte_counts(self, start=0, count=None):
+        return self.values(TILE_BYTE_COUNTS if self.is_tiled else STRIP_BYTE_COUNTS, start, count)
+
+
+class TIFF(object):
+    """ The header and IFD chain of a ClassicTIFF or BigTIFF file """
+
+    def __init__(self, reader):
+        self.reader = reader
+        header = reader.read(0, 16)
+        if len(header) < 8:
+            raise TIFFError('The file is not a TIFF')
+        if header[:2] == b'II':
+            self.byte_order = '<'
+        elif header[:2] == b'MM':
+            self.byte_order = '>'
+        else:
+            raise TIFFError('The file is not a TIFF')
+        magic, = struct.unpack(self.byte_order + 'H', header[2:4])
+        if magic == 42:
+            self.bigtiff = False
+            self.first_ifd_offset, = struct.unpack(self.byte_order + 'I', header[4:8])
+        elif magic == 43:
+            self.bigtiff = True
+            self.first_ifd_offset, = struct.unpack(self.byte_order + 'Q', header[8:16])
+        else:
+            raise TIFFError('The file is not a TIFF')
+        self.ifds = self._read_ifds()
+
+    def _read_ifds(self):
+        if self.bigtiff:
+            count_fmt, count_size, entry_size, offset_fmt, inline_size = 'Q', 8, 20, 'Q', 8
+        else:
+            count_fmt, count_size, entry_size, offset_fmt, inline_size = 'H', 2, 12, 'I', 4
+        ifds = []
+        seen = set()
+        offset = self.first_ifd_offset
+        while offset and offset not in seen:
+            seen.add(offset)
+            count, = struct.unpack(self.byte_order + count_fmt, self.reader.read(offset, count_size))
+            data = self.reader.read(offset + count_size, count * entry_size + inline_size)
+            if len(data) < count * entry_size + inline_size:
+                raise TIFFError('Truncated IFD at offset %d' % offset)
+            entries = {}
+            for i in range(count):
+                entry = data[i * entry_size:(i + 1) * entry_size]
+                tag, field_type = struct.unpack(self.byte_order + 'HH', entry[:4])
+                if field_type not in FIELD_TYPES:
+                    continue
+                field_count, = struct.unpack(self.byte_order + offset_fmt, entry[4:4 + inline_size])
+                value = entry[4 + inline_size:]
+                if FIELD_TYPES[field_type][1] * field_count <= inline_size:
+                    entries[tag] = (field_type, field_count, value, None)
+                else:
+                    value_offset, = struct.unpack(self.byte_order + offset_fmt, value)
+                    entries[tag] = (field_type, field_count, None, value_offset)
+            _check_required(entries, offset)
+            ifds.append(IFD(self, offset, entries))
+            offset, = struct.unpack(self.byte_order + offset_fmt, data[count * entry_size:])
+        if not ifds:
+            raise TIFFError('The file has no IFD')
+        return ifds
+
+    @property
+    def main(self):
+        return self.ifds[0]
+
+    @property
+    def overviews(self):
+        """ The reduced resolution IFDs, excluding masks, in file order like gdal's GetOverview """
+        return [ifd for ifd in self.ifds[1:]
+                if ifd.subfile_type & REDUCED_RESOLUTION and not ifd.subfile_type & MASK]
+
+
+def _check_required(entries, offset):
+    """ Raise TIFFError if the tags every image needs are missing from the IFD at offset, or are not integers """
+    if TILE_OFFSETS in entries:
+        required = (IMAGE_WIDTH, IMAGE_LENGTH, TILE_WIDTH, TILE_LENGTH, TILE_OFFSETS, TILE_BYTE_COUNTS)
+    else:
+        required = (IMAGE_WIDTH, IMAGE_LENGTH, STRIP_OFFSETS, STRIP_BYTE_COUNTS)
+    for tag in required:
+        if tag not in entries or entries[tag][0] not in INTEGER_TYPES or entries[tag][1] < 1:
+            raise TIFFError('Missing required tag %d in the IFD at offset %d' % (tag, offset))
+
+
+def open_tiff(source):
+    """ Return a TIFF for a file name or a reader with a read(offset, length) method """
+    if isinstance(source, str):
+        source = FileReader(source)
+    return TIFF(source)
+
+
+def validate(source, check_tiled=True):
+    """Check if a file is a (Geo)TIFF with cloud optimized compatible structure.
+
+    Same checks and results as validate_cloud_optimized_geotiff.validate(),
+    from the IFD chain only.
+
+    Args:
+      source: file name, or reader with read(offset, length) and name.
+      check_tiled: Set to False to ignore missing tiling.
+
+    Returns:
+      A tuple, whose first element is an array of error messages
+      (empty if there is no error), and the second element, a dictionary
+      with the structure of the GeoTIFF file.
+
+    Raises:
+      TIFFError: Unable to read the file or the file is not a Tiff.
+    """
+    try:
+        tiff = open_tiff(source)
+    except (IOError, OSError, ValueError, struct.error) as e:
+        raise TIFFError('Invalid file : %s' % e)
+    try:
+        return _validate(tiff, source if isinstance(source, str) else None, check_tiled)
+    except struct.error as e:
+        raise TIFFError('Invalid file : %s' % e)
+    finally:
+        tiff.reader.close()
+
+
+def _validate(tiff, filename, check_tiled):
+    details = {}
+    errors = []
+    main_ifd = tiff.main
+    overviews = tiff.overviews
+    ovr_count = len(overviews)
+    if filename is not None and os.path.exists(filename + '.ovr'):
+        errors += [
+            'Overviews found in external .ovr file. They should be internal']
+
+    if main_ifd.width >= 512 or main_ifd.height >= 512:
+        if check_tiled:
+            block_size = main_ifd.block_size
+            if block_size[0] == main_ifd.width and block_size[0] > 1024:
+                errors += [
+                    'The file is greater than 512xH or Wx512, but is not tiled']
+
+        if ovr_count == 0:
+            errors += [
+                'The file is greater than 512xH or Wx512, but has no overviews']
+
+    ifd_offset = main_ifd.offset
+    ifd_offsets = [ifd_offset]
+    if ifd_offset not in (8, 16):
+        errors += [
+            'The offset of the main IFD should be 8 for ClassicTIFF '
+            'or 16 for BigTIFF. It is %d instead' % ifd_offsets[0]]
+    details['ifd_offsets'] = {}
+    details['ifd_offsets']['main'] = ifd_offset
+
+    for i, ovr_ifd in enumerate(overviews):
+        # Check that overviews are by descending sizes
+        if i == 0:
+            if ovr_ifd.width > main_ifd.width or ovr_ifd.height > main_ifd.height:
+                errors += [
+                    'First overview has larger dimension than main band']
+        else:
+            prev_ovr_ifd = overviews[i - 1]
+            if ovr_ifd.width > prev_ovr_ifd.width or ovr_ifd.height > prev_ovr_ifd.height:
+                errors += [
+                    'Overview of index %d has larger dimension than '
+                    'overview of index %d' % (i, i - 1)]
+
+        if check_tiled:
+            block_size = ovr_ifd.block_size
+            if block_size[0] == ovr_ifd.width and block_size[0] > 1024:
+                errors += [
+                    'Overview of index %d is not tiled' % i]
+
+        # Check that the IFD of descending overviews are sorted by increasing
+        # offsets
+        ifd_offsets.append(ovr_ifd.offset)
+        details['ifd_offsets']['overview_%d' % i] = ovr_ifd.offset
+        if ifd_offsets[-1] < ifd_offsets[-2]:
+            if i == 0:
+                errors += [
+                    'The offset of the IFD for overview of index %d is %d, '
+                    'whereas it should be greater than the one of the main '
+                    'image, which is at byte %d' %
+                    (i, ifd_offsets[-1], ifd_offsets[-2])]
+            else:
+                errors += [
+                    'The offset of the IFD for overview of index %d is %d, '
+                    'whereas it should be greater than the one of index %d, '
+                    'which is at byte %d' %
+                    (i, ifd_offsets[-1], i - 1, ifd_offsets[-2])]
+
+    # Check that the imagery starts by the smallest overview and ends with
+    # the main resolution dataset
+    block_offsets = main_ifd.block_offsets(0, 1)
+    if not block_offsets or not block_offsets[0]:
+        errors += ['Missing BLOCK_OFFSET_0_0']
+    data_offset = block_offsets[0] if block_offsets and block_offsets[0] else None
+    data_offsets = [data_offset]
+    details['data_offsets'] = {}
+    details['data_offsets']['main'] = data_offset
+    for i, ovr_ifd in enumerate(overviews):
+        block_offsets = ovr_ifd.block_offsets(0, 1)
+        data_offset = block_offsets[0] if block_offsets else 0
+        data_offsets.append(data_offset)
+        details['data_offsets']['overview_%d' % i] = data_offset
+
+    if data_offsets[-1] is not None and data_offsets[-1] < ifd_offsets[-1]:
+        if ovr_count > 0:
+            errors += [
+                'The offset of the first block of the smallest overview '
+                'should be after its IFD']
+        else:
+            errors += [
+                'The offset of the first block of the image should '
+                'be after its IFD']
+    for i in range(len(data_offsets) - 2, 0, -1):
+        if data_offsets[i] < data_offsets[i + 1]:
+            errors += [
+                'The offset of the first block of overview of index %d should '
+                'be after the one of the overview of index %d' %
+                (i - 1, i)]
+    if len(data_offsets) >= 2 and data_offsets[0] is not None and data_offsets[0] < data_offsets[1]:
+        errors += [
+            'The offset of the first block of the main resolution image'
+            'should be after the one of the overview of index %d' %
+            (ovr_count - 1)]
+
+    return errors, details
@@ -0,0 +1,299 @@
+""" Validate published COGs over HTTP range requests, without downloading them
+
+    Many files are validated concurrently by one asyncio event loop: at most --concurrency files at a
+    time, their requests sharing a pool of keep-alive connections per host. tiff_ifd.validate runs on
+    the blocks fetched so far, and whenever it needs a byte range that was not fetched it is
+    interrupted, the missing blocks are fetched and it runs again. For a COG the first 16KB block
+    holds the header and all the IFDs, so most files take a single request.
+    The results are those of validate_cloud_optimized_geotiff.validate(), written like verify_cog.py.
+"""
+from os.path import join as pjoin, relpath
+from urllib.parse import urlsplit, quote
+import asyncio
+import click
+import os
+import sys
+import time
+import logging
+import struct
+from tiff_ifd import validate, TIFFError
+from verify_cog import ResultWriter
+
+BLOCK_SIZE = 16384
+# Runs of validate on the fetched blocks before giving up on a file
+MAX_PASSES = 32
+
+
+class _Missing(Exception):
+    """ Raised by the block cache for a byte range that was not fetched yet """
+
+    def __init__(self, first, last):
+        Exception.__init__(self, first, last)
+        self.first = first
+        self.last = last
+
+
+class BlockCache(object):
+    """ A reader over the blocks of a file fetched so far, raising _Missing for the others """
+
+    def __init__(self, name, block_size=BLOCK_SIZE):
+        self.name = name
+        self.block_size = block_size
+        self.blocks = {}
+        self.size = None
+
+    def read(self, offset, length):
+        first = offset // self.block_size
+        last = (offset + length - 1) // self.block_size
+        if self.size is not None:
+            last = min(last, max(first, (self.size - 1) // self.block_size))
+        missing = [index for index in range(first, last + 1) if index not in self.blocks]
+        if missing:
+            raise _Missing(missing[0], missing[-1])
+        data = b''.join(self.blocks[index] for index in range(first, last + 1))
+        start = offset - first * self.block_size
+        return data[start:start + length]
+
+    def add(self, first, data):
+        for index in range(first, first + max(1, -(-len(data) // self.block_size))):
+            self.blocks[index] = data[(index - first) * self.block_size:(index - first + 1) * self.block_size]
+
+    def close(self):
+        pass
+
+
+async def _read_response(reader):
+    """ Read an HTTP/1.1 response, return the status, the headers (lower case names), the body """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("Connection closed by the server")
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b''.join(chunks)
+    else:
+        body = await reader.read()
+        headers['connection'] = 'close'
+    return status, headers, body
+
+
+class ConnectionPool(object):
+    """ Keep-alive HTTP/1.1 connections, reused across the files of a host """
+
+    def __init__(self, timeout=30, retries=3):
+        self.timeout = timeout
+        self.retries = retries
+        self.idle = {}
+        self.requests = 0
+        self.bytes = 0
+
+    async def _connect(self, key):
+        idle = self.idle.get(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+        host, port, tls = key
+        return await asyncio.open_connection(host, port, ssl=True if tls else None)
+
+    async def get_range(self, url, offset, length):
+        """ GET length bytes of url from offset, return the status, headers and body """
+        parts = urlsplit(url)
+        tls = parts.scheme == 'https'
+        key = (parts.hostname, parts.port or (443 if tls else 80), tls)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request = ('GET {} HTTP/1.1\r\nHost: {}\r\nRange: bytes={}-{}\r\nUser-Agent: validate_remote\r\n'
+                   '\r\n'.format(path, parts.netloc, offset, offset + length - 1)).encode('latin-1')
+        for attempt in range(self.retries + 1):
+            reader = writer = None
+            try:
+                reader, writer = await asyncio.wait_for(self._connect(key), self.timeout)
+                writer.write(request)
+                await writer.drain()
+                status, headers, body = await asyncio.wait_for(_read_response(reader), self.timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError, IndexError) as e:
+                if writer is not None:
+                    writer.close()
+                if attempt == self.retries:
+                    raise TIFFError('Unable to read {}: {}'.format(url, e))
+                await asyncio.sleep(0.5 * 2 ** attempt)
+                continue
+            if headers.get('connection', '').lower() == 'close':
+                writer.close()
+            else:
+                self.idle.setdefault(key, []).append((reader, writer))
+            self.requests += 1
+            self.bytes += len(body)
+            if status >= 500 and attempt < self.retries:
+                await asyncio.sleep(0.5 * 2 ** attempt)
+                continue
+            return status, headers, body
+
+    def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle = {}
+
+
+async def validate_url(pool, url):
+    """ Validate the COG at url from the byte ranges validate() reads, return a verify_cog result record """
+    cache = BlockCache(url)
+    try:
+        for _ in range(MAX_PASSES):
+            try:
+                errors, details = validate(cache)
+                break
+            except _Missing as missing:
+                offset = missing.first * cache.block_size
+                status, headers, body = await pool.get_range(url, offset,
+                                                             (missing.last + 1) * cache.block_size - offset)
+                if status == 416:
+                    # Past the end of the file
+                    cache.add(missing.first, b'')
+                    continue
+                if status not in (200, 206):
+                    raise TIFFError('HTTP status {} reading {}'.format(status, url))
+                if status == 200:
+                    # The server ignored the Range, the body is the whole file
+                    cache.add(0, body)
+                else:
+                    cache.add(missing.first, body)
+                content_range = headers.get('content-range', '')
+                if '/' in content_range and content_range.rsplit('/', 1)[1].isdigit():
+                    cache.size = int(content_range.rsplit('/', 1)[1])
+                elif status == 200:
+                    cache.size = len(body)
+        else:
+            raise TIFFError('Too many requests reading the IFDs of {}'.format(url))
+    except (TIFFError, struct.error) as e:
+        errors, details = [str(e)], {}
+    except Exception as e:
+        # A file that can not be read is reported as not valid, it must not be dropped from the results
+        logging.exception("Unable to validate %s", url)
+        errors, details = [repr(e)], {}
+    return {'path': url, 'valid': not errors, 'errors': errors, 'details': details}
+
+
+async def validate_urls(urls, concurrency=64, timeout=30, callback=None):
+    """ Validate the urls with at most concurrency files in flight, calling callback(result) as they finish
+        Return the pool, for its request counters
+    """
+    pool = ConnectionPool(timeout)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(url):
+        async with semaphore:
+            result = await validate_url(pool, url)
+        callback(result)
+
+    # Create the tasks as slots free up, so a list of millions of urls is not scheduled up front
+    pending = set()
+    try:
+        for url in urls:
+            if len(pending) >= concurrency * 2:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Raise the exception of a failed task instead of leaving it unretrieved
+                for task in done:
+                    task.result()
+            pending.add(asyncio.ensure_future(run(url)))
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            for task in done:
+                task.result()
+    finally:
+        pool.close()
+    return pool
+
+
+def s3_url(url):
+    """ The https url of an s3://bucket/key url, for publicly readable objects """
+    parts = urlsplit(url)
+    return 'https://{}.s3.amazonaws.com/{}'.format(parts.netloc, quote(parts.path.lstrip('/')))
+
+
+def _read_urls(urls, urls_file):
+    for url in urls:
+        yield url
+    if urls_file:
+        with click.open_file(urls_file) as fp:
+            for line in fp:
+                if line.strip():
+                    yield line.strip()
+
+
+def _served_urls(root, host, port):
+    for folder, _, files in os.walk(root):
+        for fname in sorted(files):
+            if fname.endswith('.tif'):
+                yield 'http://{}:{}/{}'.format(host, port, quote(relpath(pjoin(folder, fname), root)))
+
+
+@click.command(help="\b Validate published COGs over HTTP range requests, reading only their header and IFDs.")
+@click.argument('urls', nargs=-1)
+@click.option('--urls-file', '-i', default=None, help="Read the urls from this file, one per line, - for stdin")
+@click.option('--serve', default=None, help="Serve this folder locally and validate its COGs, a stand-in for a bucket",
+              type=click.Path(exists=True, file_okay=False, readable=True))
+@click.option('--concurrency', '-c', default=64, show_default=True, help="Number of files validated at a time",
+              type=click.IntRange(min=1))
+@click.option('--timeout', default=30, show_default=True, help="Seconds to wait for a connection or a response",
+              type=click.IntRange(min=1))
+@click.option('--format', '-f', 'fmt', default='text', show_default=True, help="Format of the results",
+              type=click.Choice(['text', 'jsonl', 'csv']))
+@click.option('--output', '-o', default=None, help="Write the results to this file instead of stdout",
+              type=click.Path(dir_okay=False, writable=True))
+def main(urls, urls_file, serve, concurrency, timeout, fmt, output):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    server = None
+    if serve:
+        from range_benchmark import serve as serve_folder
+        server = serve_folder(os.path.abspath(serve))
+        host, port = server.server_address[:2]
+        url_list = _served_urls(os.path.abspath(serve), host, port)
+    else:
+        url_list = (s3_url(url) if url.startswith('s3://') else url for url in _read_urls(urls, urls_file))
+    fp = open(output, 'w', newline='') if output else sys.stdout
+    writer = ResultWriter(fp, fmt)
+    invalid = []
+
+    def write(result):
+        writer.write(result)
+        if not result['valid']:
+            invalid.append(result['path'])
+
+    start = time.perf_counter()
+    try:
+        pool = asyncio.run(validate_urls(url_list, concurrency, timeout, write))
+    finally:
+        if output:
+            fp.close()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    seconds = time.perf_counter() - start
+    logging.info("Validated %i COGs in %.1f s with %i requests, %.1f MB: %i are not valid cloud optimized GeoTIFFs",
+                 writer.count, seconds, pool.requests, pool.bytes / 1e6, len(invalid))
+    if invalid:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
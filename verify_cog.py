@@ -1,24 +1,133 @@
-import subprocess
 import click
-import sys,os
+import sys
+import os
+import csv
+import json
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from os.path import basename
+
+BACKENDS = ('gdal', 'ifd')
+
+
+def validate_file(fname, backend='gdal'):
+    """ Validate one Geotiff and return a result record
+        backend 'gdal' runs validate_cloud_optimized_geotiff.validate, 'ifd' runs tiff_ifd.validate
+    """
+    if backend == 'gdal':
+        from validate_cloud_optimized_geotiff import validate, ValidateCloudOptimizedGeoTIFFException as error_type
+    else:
+        from tiff_ifd import validate, TIFFError as error_type
+    try:
+        errors, details = validate(fname)
+    except error_type as e:
+        errors, details = [str(e)], {}
+    except Exception as e:
+        # One file that can not be read must not stop the validation of the others
+        logging.exception("Unable to validate %s", fname)
+        errors, details = [repr(e)], {}
+    return {'path': fname, 'valid': not errors, 'errors': errors, 'details': details}
+
+
+def _validate_files(fnames, backend):
+    return [validate_file(fname, backend) for fname in fnames]
+
+
+def _list_files(gtiff_path):
+    for root, subdirs, files in os.walk(gtiff_path):
+        for filename in files:
+            if filename.endswith('.tif'):
+                yield os.path.join(root, filename)
+
+
+def _batches(fnames, size):
+    batch = []
+    for fname in fnames:
+        batch.append(fname)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _results(fnames, backend, workers, batch_size=64):
+    """ Yield the validation results, validating batches of files in a process pool """
+    if workers <= 1:
+        for fname in fnames:
+            yield validate_file(fname, backend)
+        return
+    in_flight = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch in _batches(fnames, batch_size):
+            in_flight.append(executor.submit(_validate_files, batch, backend))
+            if len(in_flight) >= workers * 2:
+                for result in in_flight.pop(0).result():
+                    yield result
+        while in_flight:
+            for result in in_flight.pop(0).result():
+                yield result
+
+
+class ResultWriter(object):
+    """ Write the validation results as text lines, JSON lines or CSV """
+
+    def __init__(self, fp, fmt):
+        self.fp = fp
+        self.fmt = fmt
+        self.count = 0
+        if fmt == 'csv':
+            self.writer = csv.writer(fp)
+            self.writer.writerow(['path', 'valid', 'errors', 'ifd_offsets', 'data_offsets'])
+
+    def write(self, result):
+        self.count = self.count + 1
+        if self.fmt == 'jsonl':
+            self.fp.write(json.dumps(result) + '\n')
+        elif self.fmt == 'csv':
+            details = result['details']
+            self.writer.writerow([result['path'], result['valid'], '; '.join(result['errors']),
+                                  json.dumps(details.get('ifd_offsets', {})),
+                                  json.dumps(details.get('data_offsets', {}))])
+        else:
+            fname = basename(result['path'])
+            if result['valid']:
+                self.fp.write('%i:%s is a valid cloud optimized GeoTIFF\n' % (self.count, fname))
+            else:
+                self.fp.write('%i:%s is NOT a valid cloud optimized GeoTIFF : %s\n'
+                              % (self.count, fname, '; '.join(result['errors'])))
+
 
 @click.command(help= "\b Verify the converted Geotiffs are Cloud Optimized Geotiffs."
 " Mandatory Requirement: validate_cloud_optimized_geotiff.py gdal file")
 @click.option('--path', '-p', required = True, help="Read the Geotiffs from this folder",
                 type=click.Path(exists=True, readable=True))
-def main(path):
+@click.option('--workers', '-w', default=1, show_default=True, help="Number of processes validating files",
+              type=click.IntRange(min=1))
+@click.option('--backend', '-b', default='gdal', show_default=True,
+              help="Validate with GDAL or by reading the TIFF IFDs directly", type=click.Choice(BACKENDS))
+@click.option('--format', '-f', 'fmt', default='text', show_default=True, help="Format of the results",
+              type=click.Choice(['text', 'jsonl', 'csv']))
+@click.option('--output', '-o', default=None, help="Write the results to this file instead of stdout",
+              type=click.Path(dir_okay=False, writable=True))
+def main(path, workers, backend, fmt, output):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
     Gtiff_path = os.path.abspath(path)
-    count=0
-    for root, subdirs,files in os.walk(Gtiff_path):
-       for filename in files:
-          if filename.endswith('.tif'):
-              count = count+1
-              file_name =os.path.join(root,filename)
-              command = "python validate_cloud_optimized_geotiff.py " + file_name
-              output = subprocess.getoutput(command)
-              valid_output = (output.split('/'))[-1]
-              print(str(count)+":"+valid_output)
+    fp = open(output, 'w', newline='') if output else sys.stdout
+    writer = ResultWriter(fp, fmt)
+    invalid = 0
+    try:
+        for result in _results(_list_files(Gtiff_path), backend, workers):
+            writer.write(result)
+            if not result['valid']:
+                invalid = invalid + 1
+    finally:
+        if output:
+            fp.close()
+    logging.info("Verified %i Geotiffs, %i are not valid cloud optimized GeoTIFFs", writer.count, invalid)
+    if invalid:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()